@@ -0,0 +1,116 @@
+#!/usr/local/bin/python
+"""Script to summarize the result of an Apigee analytics report, or its columnar copy, by some of its dimensions."""
+
+import argparse
+import sys
+
+from utils import aggregator, columnar
+
+
+def split_list(value: str) -> []:
+    """Splits a comma separated argument, ignoring empty items."""
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def parse_args():
+    """Defines which arguments are needed for the script to run."""
+    parser = argparse.ArgumentParser(
+        description='summarize an Apigee analytics report with bounded memory')
+    arg_grp = parser.add_argument_group(title='accepted arguments')
+    arg_grp.add_argument(
+        '-f',
+        '--file',
+        help='path of the .csv.gz report generated by generate_report.py, or of its columnar folder',
+        required=True)
+    arg_grp.add_argument(
+        '-m',
+        '--metrics',
+        help='comma separated metric columns to sum and compute percentiles of',
+        required=True)
+    arg_grp.add_argument(
+        '-g',
+        '--group_by',
+        help='comma separated dimension columns to group the rows by - default is a single group')
+    arg_grp.add_argument(
+        '-p',
+        '--percentiles',
+        help='comma separated percentiles computed for every metric - default is 50,90,99',
+        default='50,90,99')
+    arg_grp.add_argument(
+        '-out',
+        '--output',
+        help='path of the summary, gzipped if it ends with .gz - default is the report path with .summary.csv')
+    arg_grp.add_argument(
+        '-ra',
+        '--relative_accuracy',
+        help='relative accuracy of the percentiles - default is 0.01',
+        type=float,
+        default=0.01)
+    arg_grp.add_argument(
+        '-b',
+        '--batch_size',
+        help='number of rows read at a time - default is 10000',
+        type=int,
+        default=10000)
+    arg_grp.add_argument(
+        '-np',
+        '--numpy',
+        help='vectorize the aggregation of every batch with NumPy, if it is installed',
+        action='store_true')
+    arg_grp.add_argument(
+        '-sd',
+        '--startdate',
+        help='ISO 8601 (yyyy-MM-ddTHH:mm:ss) UTC date of the first rows summarized, for columnar reports')
+    arg_grp.add_argument(
+        '-ed',
+        '--enddate',
+        help='ISO 8601 (yyyy-MM-ddTHH:mm:ss) UTC date after the last rows summarized, for columnar reports')
+
+    parsed = parser.parse_args()
+
+    if not 0 < parsed.relative_accuracy < 1:
+        parser.error('the relative accuracy must be between 0 and 1')
+    if parsed.batch_size < 1:
+        parser.error('the batch size must be at least 1')
+    if (parsed.startdate or parsed.enddate) and not columnar.is_columnar(parsed.file):
+        parser.error('the start and end dates can only be used with a columnar report')
+
+    return parsed
+
+
+def main():
+    """Method called from the main entry point of the script to do the required logic."""
+    args = parse_args()
+
+    try:
+        percentiles = [float(percent) for percent in split_list(args.percentiles)]
+    except ValueError:
+        sys.exit('Invalid percentiles: {}'.format(args.percentiles))
+
+    if args.numpy and aggregator.numpy is None:
+        print('NumPy is not installed, aggregating without it.')
+
+    path = args.file.rstrip('/')
+    output_path = args.output or '{}.summary.csv'.format(
+        path[:-len('.csv.gz')] if path.endswith('.csv.gz') else path)
+
+    report = aggregator.ReportAggregator(
+        split_list(args.group_by), split_list(args.metrics), percentiles, args.relative_accuracy)
+
+    try:
+        if columnar.is_columnar(path):
+            start = columnar.parse_timestamp(args.startdate) if args.startdate else None
+            end = columnar.parse_timestamp(args.enddate) if args.enddate else None
+            rows = columnar.ColumnarReport(path).aggregate(report, start, end, args.numpy)
+        else:
+            rows = aggregator.aggregate_csv(path, report, args.batch_size, args.numpy)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    aggregator.write_summary(report, output_path)
+
+    print('Summarized {} row(s) in {} group(s), stored in: {}'.format(rows, len(report.groups), output_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/local/bin/python
+"""Script to convert the .csv.gz result of an Apigee analytics report into a columnar folder."""
+
+import argparse
+import sys
+
+from utils import columnar
+
+
+def parse_args():
+    """Defines which arguments are needed for the script to run."""
+    parser = argparse.ArgumentParser(
+        description='convert an Apigee analytics report into a columnar folder for fast repeated analysis')
+    arg_grp = parser.add_argument_group(title='accepted arguments')
+    arg_grp.add_argument(
+        '-f',
+        '--file',
+        help='path of the .csv.gz report generated by generate_report.py',
+        required=True)
+    arg_grp.add_argument(
+        '-out',
+        '--output',
+        help='folder of the columnar copy - default is the report path ending with .columnar')
+    arg_grp.add_argument(
+        '-tc',
+        '--time_column',
+        help='column holding the time of the rows, used as index - default is the timeUnit or timestamp column')
+    arg_grp.add_argument(
+        '-bs',
+        '--block_size',
+        help='number of rows per block of the time index - default is 65536',
+        type=int,
+        default=65536)
+
+    parsed = parser.parse_args()
+
+    if parsed.block_size < 1:
+        parser.error('the block size must be at least 1')
+
+    return parsed
+
+
+def main():
+    """Method called from the main entry point of the script to do the required logic."""
+    args = parse_args()
+
+    folder = args.output or columnar.columnar_path(args.file)
+
+    try:
+        rows = columnar.convert_csv(args.file, folder, args.time_column, args.block_size)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    print('Converted {} row(s), stored in: {}'.format(rows, folder))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+#!/usr/local/bin/python
+# An exception thrown when an Apigee async query fails or does not complete in time
+class QueryException(Exception):
+    pass
@@ -0,0 +1,131 @@
+#!/usr/local/bin/python
+"""Script to export all the API Products of an Apigee organization to a gzip compressed NDJSON file."""
+
+import argparse
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+
+from service import apigee_auth, apigee_api_products
+
+# Global session used for all requests.
+REQUEST = requests.Session()
+
+
+def export_api_products(org_name: str, location: str, page_size: int, workers: int) -> int:
+    """Writes every API Product as one JSON line. Products are fetched a page at a time, with
+    the details of the products of a page fetched concurrently, so memory use does not grow
+    with the amount of products. Returns the amount of products exported."""
+    count = 0
+
+    with gzip.open(location, 'wt', encoding='utf8') as output, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for names in apigee_api_products.iter_api_product_names(REQUEST, org_name, page_size):
+            products = executor.map(
+                lambda name: apigee_api_products.get_api_product(REQUEST, org_name, name), names)
+
+            for product in products:
+                # Products deleted while exporting are skipped.
+                if product is not None:
+                    output.write(json.dumps(product, sort_keys=True) + '\n')
+                    count += 1
+
+    return count
+
+
+def parse_args():
+    """Defines which arguments are needed for the script to run."""
+    parser = argparse.ArgumentParser(
+        description='exports all the API Products of an organization to a gzip NDJSON file')
+    req_grp = parser.add_argument_group(title='required arguments')
+    req_grp.add_argument(
+        '-o',
+        '--org',
+        help='name of the organization',
+        required=True)
+    req_grp.add_argument(
+        '-u',
+        '--username',
+        help='apigee user')
+    req_grp.add_argument(
+        '-pwd',
+        '--password',
+        help='apigee password')
+    req_grp.add_argument(
+        '-rt',
+        '--refresh_token',
+        help='apigee refresh token')
+    req_grp.add_argument(
+        '-out',
+        '--output',
+        help='folder where the export is saved - default is the current directory',
+        required=False)
+    req_grp.add_argument(
+        '-f',
+        '--file',
+        help='name of the file to store the export in - default is api-products.ndjson.gz',
+        required=False)
+    req_grp.add_argument(
+        '-pgs',
+        '--page_size',
+        help='amount of API Product names listed per call - default is 1000',
+        type=int,
+        default=1000)
+    req_grp.add_argument(
+        '-w',
+        '--workers',
+        help='number of API Products fetched in parallel - default is 8',
+        type=int,
+        default=8)
+
+    parsed = parser.parse_args()
+
+    if parsed.refresh_token is None and (parsed.username is None or parsed.password is None):
+        parser.error("the following arguments are required: -u/--username and -pwd/--password OR -r/--refresh_token")
+
+    return parsed
+
+
+def main():
+    """Method called from the main entry point of the script to do the required logic."""
+    args = parse_args()
+
+    org_name = args.org
+    username = args.username
+    password = args.password
+    refresh_token = args.refresh_token
+    output_path = args.output
+    file = args.file
+
+    if output_path is None:
+        output_path = os.getcwd()
+    else:
+        Path(output_path).mkdir(parents=True, exist_ok=True)
+
+    if file is None:
+        file = 'api-products.ndjson.gz'
+
+    location = os.path.join(output_path, file)
+
+    # Retrieve an access token using the refresh token provided. This ensures
+    # that we always have a valid access token.
+    if refresh_token is not None:
+        access_token = apigee_auth.refresh_access_token(refresh_token)
+    else:
+        access_token = apigee_auth.get_access_token(username, password)
+
+    # Add Auth Header by default to all requests.
+    REQUEST.headers.update({'Authorization': 'Bearer {}'.format(access_token)})
+    REQUEST.cookies.update({'access_token': access_token})
+
+    count = export_api_products(org_name, location, args.page_size, args.workers)
+
+    print('Exported {} API Product(s) to: {}'.format(count, location))
+    return location
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,68 @@
 
 import json
 import argparse
+import os
+import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 from service import apigee_auth, apigee_reports
+from exceptions.query_exception import QueryException
+from utils import columnar, reports, utils
+from utils.cache import ContentCache, hash_bytes
 
 # Global session used for all requests.
 REQUEST = requests.Session()
 
 
+class QueryState:
+    """Async queries submitted and not downloaded yet, kept in a JSON file when a path is given so that
+    a run which was interrupted resumes them instead of submitting the same queries again."""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.queries = utils.load_state(path)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(org_name: str, env: str, query: dict) -> str:
+        """Identifies a query by everything it was submitted with."""
+        return hash_bytes(json.dumps([org_name, env, query], sort_keys=True).encode('utf-8'))
+
+    def save(self):
+        """Writes the file atomically, so that it is never left half written if the run is killed."""
+        utils.save_state(self.path, self.queries)
+
+    def submit(self, org_name: str, env: str, query: dict) -> apigee_reports.Query:
+        """Resumes the query submitted by a previous run with the same arguments if Apigee still has it
+        and it did not fail, otherwise submits the query and remembers it."""
+        key = self.key(org_name, env, query)
+        with self._lock:
+            entry = self.queries.get(key)
+
+        if entry is not None:
+            resumed = apigee_reports.find_query(REQUEST, entry['url'])
+            if resumed is not None and resumed.state not in apigee_reports.FAILED_STATES:
+                print('Resuming query {} submitted on {}. Query status: {}.'.format(
+                    resumed.url, resumed.created, resumed.state))
+                return resumed
+
+        submitted = apigee_reports.generate_async_query(REQUEST, org_name, env, query)
+        with self._lock:
+            self.queries[key] = {'url': submitted.url, 'created': submitted.created}
+            self.save()
+        return submitted
+
+    def forget(self, org_name: str, env: str, query: dict):
+        """Drops a query once its result was downloaded."""
+        with self._lock:
+            if self.queries.pop(self.key(org_name, env, query), None) is not None:
+                self.save()
+
+
 def parse_args():
     """Defines which arguments are needed for the script to run."""
     parser = argparse.ArgumentParser(
@@ -20,7 +73,8 @@ def parse_args():
     arg_grp.add_argument(
         '-f',
         '--file',
-        help='path of the analytics query JSON file',
+        help='path of the analytics query JSON file, many files can be given to run them all in one batch',
+        nargs='+',
         required=True)
     arg_grp.add_argument(
         '-o',
@@ -30,7 +84,8 @@ def parse_args():
     arg_grp.add_argument(
         '-e',
         '--env',
-        help='existing environment in the organization to base the report on',
+        help='existing environment in the organization to base the report on, many can be given for a batch',
+        nargs='+',
         required=True)
     arg_grp.add_argument(
         '-out',
@@ -65,26 +120,256 @@ def parse_args():
         '-rt',
         '--refresh_token',
         help='apigee refresh token')
+    arg_grp.add_argument(
+        '-t',
+        '--timeout',
+        help='seconds to wait for the report to complete, 0 to wait forever - default is 3600',
+        type=float,
+        default=3600)
+    arg_grp.add_argument(
+        '-mpi',
+        '--max_poll_interval',
+        help='maximum seconds between two checks of the report status - default is 30',
+        type=float,
+        default=30)
+    arg_grp.add_argument(
+        '-csv',
+        '--only_csv_gz',
+        help='only save the .csv.gz file of the query result',
+        action='store_true')
+    arg_grp.add_argument(
+        '-win',
+        '--shard',
+        help='split the date range into day or week windows queried in parallel, merged in one .csv.gz',
+        choices=reports.SHARD_UNITS)
+    arg_grp.add_argument(
+        '-nr',
+        '--retries',
+        help='number of times a failed window is queried again when sharding - default is 2',
+        type=int,
+        default=2)
+    arg_grp.add_argument(
+        '-w',
+        '--workers',
+        help='number of windows or batch queries submitted or downloaded at the same time - default is 4',
+        type=int,
+        default=4)
+    arg_grp.add_argument(
+        '-c',
+        '--cache',
+        help='when sharding, reuse the results of windows which were already downloaded',
+        action='store_true')
+    arg_grp.add_argument(
+        '-cd',
+        '--cache_dir',
+        help='folder of the result cache - default is ~/.cache/apigee-automation')
+    arg_grp.add_argument(
+        '-cma',
+        '--cache_max_age',
+        help='days after which an unused cached result is removed - default is 90',
+        type=float,
+        default=90)
+    arg_grp.add_argument(
+        '-cms',
+        '--cache_max_size',
+        help='maximum size of the result cache in MB - default is 1024',
+        type=float,
+        default=1024)
+    arg_grp.add_argument(
+        '-col',
+        '--columnar',
+        help='also convert the result into a columnar folder for fast repeated analysis',
+        action='store_true')
+    arg_grp.add_argument(
+        '-qs',
+        '--state_file',
+        help='path of a JSON file remembering the submitted queries, so that an interrupted run '
+             'started again with the same arguments resumes them')
 
     parsed = parser.parse_args()
 
     if parsed.refresh_token is None and (parsed.username is None or parsed.password is None):
-        parser.error("the following arguments are required: -u/--username and -pwd/--password OR -r/--refresh_token")
+        parser.error("the following arguments are required: -u/--username and -pwd/--password OR -rt/--refresh_token")
+
+    if parsed.shard is not None and len(parsed.file) * len(parsed.env) > 1:
+        parser.error('sharding can only be used with a single query file and environment')
 
     return parsed
 
 
+def window_query(query: dict, window: tuple) -> dict:
+    """The query restricted to a single time window."""
+    return dict(query, timeRange={'start': window[0], 'end': window[1]})
+
+
+def run_windows(org_name: str, env: str, query: dict, windows: [], args, state: QueryState) -> {}:
+    """Submits one query per window and polls them all together. Windows whose query failed
+    are submitted again, up to the number of retries. Returns the completed queries by window."""
+    deadline = time.monotonic() + args.timeout if args.timeout else None
+    completed = {}
+    pending = list(windows)
+
+    for attempt in range(args.retries + 1):
+        if attempt:
+            print('Retrying {} failed window(s).'.format(len(pending)))
+
+        submitted = utils.run_concurrently(
+            lambda window: state.submit(org_name, env, window_query(query, window)), pending, args.workers)
+        submitted.print_summary('Submitted')
+
+        remaining = max(0.001, deadline - time.monotonic()) if deadline is not None else None
+        queries = apigee_reports.wait_for_queries(REQUEST, submitted.succeeded, remaining, args.max_poll_interval)
+        completed.update({window: query for window, query in queries.items() if query.state == 'completed'})
+
+        pending = [window for window in windows if window not in completed]
+        timed_out = [window for window, query in queries.items()
+                     if query.state != 'completed' and query.state not in apigee_reports.FAILED_STATES]
+        if not pending or timed_out:
+            break
+
+    return completed
+
+
+def generate_sharded_report(org_name: str, env: str, query: dict, args, state: QueryState) -> str:
+    """Splits the date range of the query into windows which are queried in parallel, then merges
+    the results in chronological order into a single .csv.gz file. Returns the path of that file."""
+    try:
+        reports.check_shard_unit(query.get('groupByTimeUnit'), args.shard)
+        windows = reports.split_time_range(args.startdate, args.enddate, args.shard)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    cache = ContentCache('reports', args.cache_dir) if args.cache else None
+    keys = {window: reports.window_cache_key(org_name, env, query, window) for window in windows}
+    cached = {}
+    if cache is not None:
+        for window in windows:
+            if os.path.exists(cache.path_for(keys[window])):
+                cache.touch(keys[window])
+                cached[window] = cache.path_for(keys[window])
+
+    to_query = [window for window in windows if window not in cached]
+    print('Querying {} {} window(s), {} cached.'.format(len(to_query), args.shard, len(cached)))
+
+    completed = run_windows(org_name, env, query, to_query, args, state) if to_query else {}
+    missing = [window for window in to_query if window not in completed]
+    if missing:
+        sys.exit('{} window(s) did not complete: {}'.format(
+            len(missing), ', '.join('{} - {}'.format(*window) for window in missing)))
+
+    output_name = '{}-{}-{}-{}.csv.gz'.format(org_name, env, args.startdate, args.enddate).replace(':', '')
+    output_path = os.path.join(args.output or os.getcwd(), output_name)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Every window is downloaded in its own folder as the result files may share a name.
+        downloaded = utils.run_concurrently(
+            lambda window: apigee_reports.get_query_result(
+                REQUEST, completed[window].url, tempfile.mkdtemp(dir=temp_dir), True),
+            to_query, args.workers)
+        if downloaded.failed:
+            downloaded.print_summary('Downloaded')
+            sys.exit(1)
+
+        parts = dict(cached)
+        parts.update(downloaded.succeeded)
+        if cache is not None:
+            # Only windows whose data won't change any more are cached.
+            for window in to_query:
+                if reports.window_elapsed(window):
+                    parts[window] = cache.put_file(keys[window], parts[window])
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        reports.merge_csv_gz([parts[window] for window in windows], output_path)
+
+    for window in to_query:
+        state.forget(org_name, env, window_query(query, window))
+
+    if cache is not None:
+        removed = cache.evict(args.cache_max_age * 86400, int(args.cache_max_size * 1024 * 1024))
+        if removed:
+            print('Removed {} result(s) from the cache.'.format(removed))
+
+    print('Merged report stored in: {}'.format(output_path))
+    return output_path
+
+
+def load_query(query_path: str, args) -> dict:
+    """Reads a query JSON file and sets the dates and time unit given as arguments."""
+    # Read JSON file containing analytics query setup information.
+    data = open(query_path, 'r', encoding='utf8').read()
+    query = json.loads(data)
+
+    # Set the start and end date for the report in the given JSON.
+    # This is so that the dates can be modified flexibly without modifying the JSON.
+    query.update({'timeRange': {'start': args.startdate, 'end': args.enddate}})
+
+    # Set the groupByTimeUnit if provided in the query
+    if args.groupbytimeunit is not None:
+        query.update({'groupByTimeUnit': args.groupbytimeunit})
+
+    return query
+
+
+def convert_result(location: str, args) -> str:
+    """Converts a downloaded result into a columnar folder if requested. Returns the location of the result."""
+    if args.columnar:
+        folder = columnar.columnar_path(location)
+        rows = columnar.convert_csv(location, folder)
+        print('Converted {} row(s) into columnar folder: {}'.format(rows, folder))
+
+    return location
+
+
+def run_batch(org_name: str, jobs: [], args, state: QueryState) -> utils.BatchResult:
+    """Runs the queries of many (query file, environment) jobs at once: all the queries are submitted
+    up front, polled together, and the result of each is downloaded as soon as it completed.
+    Every result is saved in a <query file name>-<environment> folder of the output path."""
+    queries = {job: load_query(job[0], args) for job in jobs}
+    result = utils.BatchResult()
+
+    submitted = utils.run_concurrently(
+        lambda job: state.submit(org_name, job[1], queries[job]),
+        jobs, args.workers)
+    result.failed.update(submitted.failed)
+
+    def download(job: tuple, query: apigee_reports.Query) -> str:
+        folder = os.path.join(args.output or os.getcwd(), '{}-{}'.format(
+            os.path.splitext(os.path.basename(job[0]))[0], job[1]))
+        os.makedirs(folder, exist_ok=True)
+        location = apigee_reports.get_query_result(REQUEST, query.url, folder, args.only_csv_gz)
+        state.forget(org_name, job[1], queries[job])
+        return convert_result(location, args)
+
+    print('Please wait while {} report(s) finish compiling.'.format(len(submitted.succeeded)))
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        downloads = {}
+
+        def on_done(job: tuple, query: apigee_reports.Query):
+            if query.state == 'completed':
+                downloads[executor.submit(download, job, query)] = job
+
+        states = apigee_reports.wait_for_queries(
+            REQUEST, submitted.succeeded, args.timeout, args.max_poll_interval, on_done)
+        downloaded = utils.collect_results(downloads)
+
+    result.succeeded.update(downloaded.succeeded)
+    result.failed.update(downloaded.failed)
+    for job, query in states.items():
+        if query.state in apigee_reports.FAILED_STATES:
+            result.failed[job] = 'Query ended in state: {}.'.format(query.state)
+        elif query.state != 'completed':
+            result.failed[job] = 'Query did not complete within {} seconds, last status: {}.'.format(
+                args.timeout, query.state)
+
+    return result
+
+
 def main():
     """Method called from the main entry point of the script to do the required logic."""
     args = parse_args()
 
-    query_path = args.file
     org_name = args.org
-    env = args.env
     output_path = args.output
-    start_date = args.startdate
-    end_date = args.enddate
-    group_by_time_unit = args.groupbytimeunit
     username = args.username
     password = args.password
     refresh_token = args.refresh_token
@@ -100,31 +385,33 @@ def main():
     REQUEST.headers.update({'Authorization': 'Bearer {}'.format(access_token)})
     REQUEST.cookies.update({'access_token': access_token})
 
-    # Read JSON file containing analytics query setup information.
-    data = open(query_path, 'r', encoding='utf8').read()
-    query = json.loads(data)
+    state = QueryState(args.state_file)
+    jobs = [(query_path, env) for query_path in args.file for env in args.env]
+    if len(jobs) > 1:
+        result = run_batch(org_name, jobs, args, state)
+        result.print_summary('Generated')
+        if result.failed:
+            sys.exit(1)
+        return
 
-    # Set the start and end date for the report in the given JSON.
-    # This is so that the dates can be modified flexibly without modifying the JSON.
-    query.update({'timeRange': {'start': start_date, 'end': end_date}})
+    query = load_query(jobs[0][0], args)
 
-    # Set the groupByTimeUnit if provided in the query
-    if group_by_time_unit is not None:
-        query.update({'groupByTimeUnit': group_by_time_unit})
+    if args.shard is not None:
+        convert_result(generate_sharded_report(org_name, jobs[0][1], query, args, state), args)
+        return
 
-    query = apigee_reports.generate_async_query(REQUEST, org_name, env, query)
+    submitted = state.submit(org_name, jobs[0][1], query)
 
     print('Please wait while report finishes compiling.')
-    while query.state != 'completed':
-        # Wait 5 seconds before checking if the query has completed.
-        time.sleep(5)
-        query = apigee_reports.get_query_status(REQUEST, query.url)
+    try:
+        submitted = apigee_reports.wait_for_query(REQUEST, submitted, args.timeout, args.max_poll_interval)
+    except QueryException as error:
+        sys.exit(str(error))
 
     # If the output path is specified, save the result there.
-    if not output_path:
-        apigee_reports.get_query_result(REQUEST, query.url)
-    else:
-        apigee_reports.get_query_result(REQUEST, query.url, output_path)
+    location = apigee_reports.get_query_result(REQUEST, submitted.url, output_path, args.only_csv_gz)
+    state.forget(org_name, jobs[0][1], query)
+    convert_result(location, args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+#!/usr/local/bin/python
+"""Module providing REST calls related to API Products on Apigee."""
+from utils import utils
+
+APIGEE_API_URL = 'https://api.enterprise.apigee.com/v1/organizations/{}/apiproducts'
+
+
+def list_api_products(session, org_name: str, page_size: int = 1000) -> {}:
+    """Retrieves the details of all the API Products of an organization, by name. Products are
+    listed in pages of expanded products, so no call per product is needed."""
+    products = {}
+    start_key = None
+
+    while True:
+        params = {'expand': 'true', 'count': page_size}
+        if start_key is not None:
+            params['startKey'] = start_key
+
+        response = session.get(APIGEE_API_URL.format(org_name), params=params)
+
+        if response.status_code != 200:
+            raise Exception(utils.print_error(response))
+
+        page = response.json().get('apiProduct', [])
+        # The start key is included in the page it starts.
+        new_products = [product for product in page if product['name'] not in products]
+
+        for product in new_products:
+            products[product['name']] = product
+
+        if len(page) < page_size or not new_products:
+            break
+
+        start_key = page[-1]['name']
+
+    print('Successfully fetched {} API Products.'.format(len(products)))
+    return products
+
+
+def iter_api_product_names(session, org_name: str, page_size: int = 1000):
+    """Yields the names of all the API Products of an organization, one page at a time."""
+    seen = set()
+    start_key = None
+
+    while True:
+        params = {'count': page_size}
+        if start_key is not None:
+            params['startKey'] = start_key
+
+        response = session.get(APIGEE_API_URL.format(org_name), params=params)
+
+        if response.status_code != 200:
+            raise Exception(utils.print_error(response))
+
+        page = response.json()
+        # The start key is included in the page it starts.
+        new_names = [name for name in page if name not in seen]
+        seen.update(new_names)
+
+        yield new_names
+
+        if len(page) < page_size or not new_names:
+            return
+
+        start_key = page[-1]
+
+
+def get_api_product(session, org_name: str, product_name: str) -> dict:
+    """Retrieves the details of an API Product, None if it does not exist."""
+    response = session.get((APIGEE_API_URL + '/{}').format(org_name, product_name))
+
+    if response.status_code == 404:
+        return None
+
+    if response.status_code != 200:
+        raise Exception(utils.print_error(response))
+
+    return response.json()
+
+
+def create_api_product(session, org_name: str, product_json: dict):
+    """Creates an API Product in Apigee."""
+    response = session.post(APIGEE_API_URL.format(org_name), json=product_json)
+
+    if response.status_code != 201:
+        raise Exception(utils.print_error(response))
+
+    print("Successfully created API Product with name '{}'.".format(product_json['name']))
+
+
+def update_api_product(session, org_name: str, product_json: dict):
+    """Updates an existing API Product in Apigee."""
+    product_name: str = product_json['name']
+
+    response = session.put((APIGEE_API_URL + '/{}').format(org_name, product_name), json=product_json)
+
+    if response.status_code != 200:
+        raise Exception(utils.print_error(response))
+
+    print("Successfully updated API Product with name '{}'.".format(product_name))
@@ -1,5 +1,7 @@
 #!/usr/local/bin/python
 """REST calls to add or delete assets from an apigee portal."""
+import os
+
 from utils import utils
 
 
@@ -68,18 +70,32 @@ def delete_remote_asset(session, portal_id: str, org_name: str, file_name: str):
     response = session.post(url, json={'orgname': org_name, 'filename': file_name})
 
     if response.status_code != 200:
-        print(utils.print_error(response))
-    else:
-        print('Successfully deleted ' + file_name + ' from Apigee portal!')
+        raise Exception(utils.print_error(response))
+
+    print('Successfully deleted ' + file_name + ' from Apigee portal!')
 
 
-def add_remote_asset(session, portal_id: str, local_file_path: str):
-    """Upload an asset to the portal."""
+def delete_remote_assets(session, portal_id: str, org_name: str, file_names: [],
+                         max_workers: int = 8) -> utils.BatchResult:
+    """Delete many assets from the remote site in parallel. Failures do not stop the
+    other deletions, they are reported in the returned result."""
+    return utils.run_concurrently(
+        lambda file_name: delete_remote_asset(session, portal_id, org_name, file_name),
+        file_names,
+        max_workers)
+
+
+def add_remote_asset(session, portal_id: str, local_file_path: str, content: bytes = None):
+    """Upload an asset to the portal. If content is given it is uploaded instead
+    of the file's content, under the file's name."""
     url = 'https://apigee.com/portals/api/sites/{}/file/post'.format(portal_id)
 
     # Make sure the the dictionary's key is 'file'.
-    file = open(local_file_path, 'rb')
-    response = session.post(url, files={'file': file})
+    if content is None:
+        with open(local_file_path, 'rb') as file:
+            response = session.post(url, files={'file': file})
+    else:
+        response = session.post(url, files={'file': (os.path.basename(local_file_path), content)})
 
     if response.status_code != 200:
         raise Exception(
@@ -4,6 +4,11 @@ import json
 
 from utils import utils
 
+# Theme fields holding SCSS/JSON text and base64 encoded images respectively.
+TEXT_FIELDS = ['variables', 'overrides', 'customScss']
+IMAGE_FIELDS = ['logo', 'mobileLogo', 'favicon']
+
+
 class Theme:
     """Class containing details of an Apigee Portal theme."""
     def __init__(self, variables: str, overrides: str, custom_scss: str,
@@ -19,7 +24,8 @@ class Theme:
 
 
 def get_current_theme(session, portal_id: str) -> Theme:
-    """Retrieves the current theme settings for the current portal."""
+    """Retrieves the current theme settings for the current portal. Note that the
+    images of the published theme are URLs rather than base64 encoded content."""
     response = session.get(
         'https://apigee.com/portals/api/sites/{}/customcss'.format(portal_id))
 
@@ -3,17 +3,51 @@ from utils import utils
 """Script containing REST calls to generate an Apigee query, get its status and download the result."""
 
 import zipfile
-import io
 import os
+import shutil
+import tempfile
+import time
+
+from exceptions.query_exception import QueryException
+
+# States in which an async query will never complete.
+FAILED_STATES = ['failed', 'error', 'expired', 'cancelled']
 
 
 class Query:
     """Class containing details related to an Apigee query."""
-    def __init__(self, url: str, state: str, created: str):
+    def __init__(self, url: str, state: str, created: str, retry_after: float = None):
         super().__init__()
         self.url = url
         self.state = state
         self.created = created
+        self.retry_after = retry_after
+
+
+class PollSchedule:
+    """Delays between status checks of a query: short at first so that small queries return
+    quickly, then growing exponentially up to a cap. A Retry-After sent by Apigee takes precedence."""
+    def __init__(self, initial_delay: float = 1, factor: float = 2, max_delay: float = 30):
+        self.delay = initial_delay
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def next_delay(self, retry_after: float = None) -> float:
+        """Returns how long to wait before the next status check."""
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        delay = self.delay
+        self.delay = min(self.delay * self.factor, self.max_delay)
+        return delay
+
+
+def parse_retry_after(response) -> float:
+    """Returns the amount of seconds of a Retry-After header, None if there is none."""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
 
 
 def get_query_status(session, query_url: str) -> Query:
@@ -25,10 +59,23 @@ def get_query_status(session, query_url: str) -> Query:
         raise Exception(utils.print_error(response))
 
     data = response.json()
-    query = Query(data['self'], data['state'], data['created'])
-    print('Query status: {}.'.format(query.state))
+    return Query(data['self'], data['state'], data['created'], parse_retry_after(response))
 
-    return query
+
+def find_query(session, query_url: str) -> Query:
+    """Get the current status of an async query submitted earlier, None if Apigee does not know it
+    any more, e.g. because its result expired."""
+
+    response = session.get('https://api.enterprise.apigee.com/v1{}'.format(query_url))
+
+    if response.status_code in (404, 410):
+        return None
+
+    if response.status_code != 200:
+        raise Exception(utils.print_error(response))
+
+    data = response.json()
+    return Query(data['self'], data['state'], data['created'], parse_retry_after(response))
 
 
 def generate_async_query(session, org_name: str, env: str, data: str) -> Query:
@@ -47,22 +94,124 @@ def generate_async_query(session, org_name: str, env: str, data: str) -> Query:
     return query
 
 
-def get_query_result(session, query_url: str, output_path=os.getcwd()) -> str:
-    """Get the Apigee async query result in zip format. This is then extracted
-    and the output is saved as '.csv.gz' either in the current directory or 
-    in the one provided."""
+def wait_for_queries(session, queries: {}, timeout: float = None, max_delay: float = 30, on_done=None) -> {}:
+    """Polls many async queries in a single loop until they all completed, failed or the timeout
+    (in seconds) expired. Each query is checked on its own adaptive schedule, and on_done(key, query)
+    is called as soon as a query completed or failed. Returns the last known state of every query,
+    by the same keys as the given queries."""
+    deadline = time.monotonic() + timeout if timeout else None
+    queries = dict(queries)
+    schedules = {key: PollSchedule(max_delay=max_delay) for key in queries}
+    due = {key: time.monotonic() + schedules[key].next_delay(query.retry_after)
+           for key, query in queries.items() if query.state != 'completed' and query.state not in FAILED_STATES}
+
+    if on_done is not None:
+        for key, query in queries.items():
+            if key not in due:
+                on_done(key, query)
+
+    while due:
+        key = min(due, key=due.get)
+        wake_up = due[key]
+        # A query whose next check falls after the deadline is checked one last time at the deadline.
+        last_check = deadline is not None and wake_up >= deadline
+        if last_check:
+            wake_up = deadline
+        time.sleep(max(0, wake_up - time.monotonic()))
+
+        previous_state = queries[key].state
+        query = get_query_status(session, queries[key].url)
+        queries[key] = query
+        if query.state != previous_state:
+            if len(queries) > 1:
+                label = ' '.join(str(part) for part in key) if isinstance(key, tuple) else key
+                print('Query {} status: {}.'.format(label, query.state))
+            else:
+                print('Query status: {}.'.format(query.state))
+
+        if query.state == 'completed' or query.state in FAILED_STATES:
+            del due[key]
+            if on_done is not None:
+                on_done(key, query)
+        elif last_check:
+            del due[key]
+        else:
+            due[key] = time.monotonic() + schedules[key].next_delay(query.retry_after)
+
+    return queries
+
+
+def wait_for_query(session, query: Query, timeout: float = None, max_delay: float = 30) -> Query:
+    """Polls an async query until it completed. Raises a QueryException if the query
+    failed or did not complete within the timeout (in seconds)."""
+    query = wait_for_queries(session, {query.url: query}, timeout, max_delay)[query.url]
+
+    if query.state in FAILED_STATES:
+        raise QueryException('Query {} ended in state: {}.'.format(query.url, query.state))
+
+    if query.state != 'completed':
+        raise QueryException('Query {} did not complete within {} seconds, last status: {}.'.format(
+            query.url, timeout, query.state))
 
-    response = session.get('https://api.enterprise.apigee.com/v1{}/result'.format(query_url))
+    return query
 
-    if response.status_code != 200:
-        raise Exception(utils.print_error(response))
 
-    print('Successfully fetched query result.')
+def download_to(response, target, chunk_size: int = 1024 * 1024):
+    """Writes a streamed response to a file object in chunks, printing the progress
+    every 10% when the size is known, or every 100 MB otherwise."""
+    total = int(response.headers.get('Content-Length') or 0)
+    step = total // 10 if total else 100 * 1024 * 1024
+    downloaded = 0
+    next_report = step
 
-    z = zipfile.ZipFile(io.BytesIO(response.content))
-    z.extractall(output_path)
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        target.write(chunk)
+        downloaded += len(chunk)
+        if step and downloaded >= next_report:
+            if total:
+                print('Downloaded {:.1f} MB ({:.0f}%).'.format(downloaded / 1048576, 100 * downloaded / total))
+            else:
+                print('Downloaded {:.1f} MB.'.format(downloaded / 1048576))
+            next_report += step
 
-    location = output_path + '/' + z.filelist[0].filename
+
+def get_query_result(session, query_url: str, output_path: str = None, only_csv_gz: bool = False,
+                     chunk_size: int = 1024 * 1024) -> str:
+    """Get the Apigee async query result in zip format. This is then extracted
+    and the output is saved as '.csv.gz' either in the current directory or 
+    in the one provided. The zip is streamed to a temporary file and its members are
+    extracted in chunks, so the result is never fully loaded in memory. With only_csv_gz,
+    only the '.csv.gz' member is extracted, as is."""
+    output_path = output_path or os.getcwd()
+    os.makedirs(output_path, exist_ok=True)
+
+    with session.get('https://api.enterprise.apigee.com/v1{}/result'.format(query_url), stream=True) as response:
+        if response.status_code != 200:
+            raise Exception(utils.print_error(response))
+
+        with tempfile.TemporaryFile() as temp:
+            download_to(response, temp, chunk_size)
+            print('Successfully fetched query result.')
+
+            temp.seek(0)
+            with zipfile.ZipFile(temp) as archive:
+                members = [member for member in archive.infolist() if not member.is_dir()]
+                if only_csv_gz:
+                    members = [member for member in members if member.filename.endswith('.csv.gz')][:1]
+
+                locations = []
+                for member in members:
+                    # Only the file name is kept, so that members can't be written outside the output path.
+                    location = os.path.join(output_path, os.path.basename(member.filename))
+                    with archive.open(member) as source, open(location, 'wb') as target:
+                        shutil.copyfileobj(source, target, chunk_size)
+                    locations.append(location)
+
+    if not locations:
+        raise Exception('The query result of {} is empty.'.format(query_url))
+
+    # The '.csv.gz' file is the result itself, any other file of the zip is secondary.
+    location = next((location for location in locations if location.endswith('.csv.gz')), locations[0])
     print('File stored in: {}'.format(location))
 
     return location
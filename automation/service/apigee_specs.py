@@ -0,0 +1,92 @@
+#!/usr/local/bin/python
+"""Module providing REST calls related to the OpenAPI specs stored on Apigee."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import utils
+
+
+class Spec:
+    """Class containing details of an Apigee OpenAPI spec."""
+
+    def __init__(self, name: str, spec_id: str, folder_id: int, modified: str = None):
+        self.name = name
+        self.spec_id = spec_id
+        self.folder_id = folder_id
+        self.modified = modified
+
+
+class SpecCatalog:
+    """Index of all the specs of an organization by name, across the home folder and its sub folders.
+    If the same name is used in more than one folder, the spec closest to the home folder is kept."""
+
+    def __init__(self, home_folder_id: str):
+        self.home_folder_id = home_folder_id
+        self.specs = {}
+        self._lock = threading.Lock()
+
+    def get(self, spec_name: str) -> Spec:
+        """Returns the spec with the given name, None if there is no such spec."""
+        return self.specs.get(spec_name)
+
+    def add(self, spec: Spec):
+        """Adds a spec to the index, for example after creating it."""
+        with self._lock:
+            self.specs.setdefault(spec.name, spec)
+
+
+# Catalogs already crawled during this run, by organization name.
+_CATALOGS = {}
+_CATALOGS_LOCK = threading.Lock()
+
+
+def get_folder(session, org_name: str, folder_id: str = 'home') -> {}:
+    """Retrieves a spec folder together with its contents."""
+    response = session.get(
+        'https://apigee.com/dapi/api/organizations/{}/specs/folder/{}'.format(org_name, folder_id))
+
+    if response.status_code != 200:
+        raise Exception(utils.print_error(response))
+
+    return response.json()
+
+
+def get_spec_content(session, org_name: str, spec_id: str) -> bytes:
+    """Retrieves the current content of a spec file."""
+    response = session.get(
+        'https://apigee.com/dapi/api/organizations/{}/specs/doc/{}/content'.format(org_name, spec_id))
+
+    if response.status_code != 200:
+        raise Exception(utils.print_error(response))
+
+    return response.content
+
+
+def get_spec_catalog(session, org_name: str, max_workers: int = 8, refresh: bool = False) -> SpecCatalog:
+    """Crawls the spec folders of the organization and indexes all the specs by name. Each level of
+    sub folders is fetched concurrently. The catalog is cached for the rest of the run unless refresh is set."""
+    with _CATALOGS_LOCK:
+        if not refresh and org_name in _CATALOGS:
+            return _CATALOGS[org_name]
+
+        home = get_folder(session, org_name)
+        catalog = SpecCatalog(home['id'])
+        level = [home]
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            while level:
+                sub_folder_ids = []
+                for folder in level:
+                    for item in folder.get('contents', []):
+                        if item.get('kind') == 'Folder':
+                            sub_folder_ids.append(item['id'])
+                        else:
+                            catalog.add(Spec(item['name'], item['id'], item['folder'], item.get('modified')))
+
+                level = list(executor.map(lambda folder_id: get_folder(session, org_name, folder_id),
+                                          sub_folder_ids))
+
+        print('Successfully fetched {} OpenAPI Specs from Apigee.'.format(len(catalog.specs)))
+
+        _CATALOGS[org_name] = catalog
+        return catalog
@@ -3,62 +3,108 @@
 
 import json
 import argparse
+import gzip
+import os
+import sys
 import requests
 
-from service import apigee_auth
+from service import apigee_auth, apigee_api_products
+from utils import utils
 
 # Global session used for all requests.
 REQUEST = requests.Session()
 
+# Fields managed by Apigee which are never part of a product definition.
+SERVER_MANAGED_FIELDS = ['createdAt', 'createdBy', 'lastModifiedAt', 'lastModifiedBy']
 
-def print_error(response) -> str:
-    """Prints the error returned from an API call."""
-    return 'Error: {}. \n {}'.format(response.status_code, response.json())
+# List fields where the order of the items has no meaning.
+UNORDERED_FIELDS = ['apiResources', 'proxies', 'environments', 'scopes']
 
 
-def product_exists(name: str, org_name: str) -> bool:
-    """Checks if a product with the given name already exists in the given Apigee organization."""
-    response = REQUEST.get(
-        'https://api.enterprise.apigee.com/v1/organizations/{}/apiproducts'.format(org_name))
+def load_products(product_path: str, folder: str, import_file: str = None) -> {}:
+    """Reads the API Product JSON files to create or update, by product name, together
+    with the products of an export made by export_api_products.py."""
+    paths = [product_path] if product_path else []
 
-    if response.status_code != 200:
-        print_error(response)
-        raise response.raise_for_status()
+    if folder:
+        paths += [entry.path for entry in sorted(os.scandir(folder), key=lambda entry: entry.name)
+                  if entry.is_file() and entry.name.endswith('.json')]
 
-    for product_name in response.json():
-        if product_name == name:
-            return True
+    products = {}
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as file:
+            product = json.load(file)
 
-    return False
+        # Name is mandatory in the JSON file, otherwise we would not know
+        # whether we want to create or update.
+        if 'name' not in product:
+            raise IOError('API Product name not specified in JSON file {}.'.format(path))
 
+        products[product['name']] = product
 
-def create_api_product(org_name: str, product_json: str):
-    """Creates an API Product in Apigee."""
-    response = REQUEST.post(
-        'https://api.enterprise.apigee.com/v1/organizations/{}/apiproducts'.format(org_name),
-        json=product_json)
+    if import_file:
+        with gzip.open(import_file, 'rt', encoding='utf8') as file:
+            for line in file:
+                if line.strip():
+                    product = json.loads(line)
+                    products[product['name']] = {field: value for field, value in product.items()
+                                                 if field not in SERVER_MANAGED_FIELDS}
 
-    if response.status_code != 201:
-        print_error(response)
-        raise response.raise_for_status()
+    return products
 
-    print("Successfully created API Product with name '{}'.".format(
-        product_json['name']))
 
+def normalize_api_product(product: dict) -> dict:
+    """Returns the product without server managed fields and empty values, with the attributes
+    and the unordered lists sorted, so that two equivalent products compare equal."""
+    normalized = {}
 
-def update_api_product(org_name: str, product_json: str):
-    """Updates an existing API Product in Apigee"""
-    product_name: str = product_json['name']
+    for field, value in product.items():
+        if field in SERVER_MANAGED_FIELDS or value in (None, '', [], {}):
+            continue
+        if field == 'attributes':
+            value = sorted(value, key=lambda attribute: (attribute.get('name'), str(attribute.get('value'))))
+        elif field in UNORDERED_FIELDS:
+            value = sorted(value, key=str)
+        normalized[field] = value
 
-    response = REQUEST.put(
-        'https://api.enterprise.apigee.com/v1/organizations/{}/apiproducts/{}'.format(
-            org_name, product_name), json=product_json)
+    return normalized
 
-    if response.status_code != 200:
-        print_error(response)
-        raise response.raise_for_status()
 
-    print("Successfully updated API Product with name '{}'.".format(product_name))
+def diff_api_products(current: dict, product: dict) -> {}:
+    """Returns the fields which differ between the current and the new product,
+    with their (current, new) normalized values."""
+    current = normalize_api_product(current)
+    product = normalize_api_product(product)
+
+    return {field: (current.get(field), product.get(field))
+            for field in sorted(set(current) | set(product))
+            if current.get(field) != product.get(field)}
+
+
+def sync_api_product(org_name: str, product: dict, current: dict, force: bool = False) -> str:
+    """Creates the API Product or updates it if it already exists. Unless forced, products which
+    are the same as the current ones are not updated, to keep their last modified date.
+    Returns whether the product was 'created', 'updated' or 'unchanged'."""
+    product_name: str = product['name']
+
+    if current is None:
+        print("API Product with name '{}' does not exist. Creating it in Apigee."
+              .format(product_name))
+        apigee_api_products.create_api_product(REQUEST, org_name, product)
+        return 'created'
+
+    differences = diff_api_products(current, product)
+
+    if not differences and not force:
+        print("API Product with name '{}' is unchanged, skipping update.".format(product_name))
+        return 'unchanged'
+
+    lines = ['  {}: {} -> {}'.format(field, json.dumps(old), json.dumps(new))
+             for field, (old, new) in differences.items()]
+    print("API Product with name '{}' already exists. Performing an update.\n{}"
+          .format(product_name, '\n'.join(lines)).rstrip())
+    apigee_api_products.update_api_product(REQUEST, org_name, product)
+    return 'updated'
 
 
 def parse_args():
@@ -69,8 +115,15 @@ def parse_args():
     req_grp.add_argument(
         '-f',
         '--file',
-        help='path of the API Product JSON file',
-        required=True)
+        help='path of the API Product JSON file')
+    req_grp.add_argument(
+        '-d',
+        '--folder',
+        help='path of a folder of API Product JSON files to create or update')
+    req_grp.add_argument(
+        '-i',
+        '--import_file',
+        help='path of an API Product export (.ndjson.gz) to create or update')
     req_grp.add_argument(
         '-o',
         '--org',
@@ -88,13 +141,26 @@ def parse_args():
         '-rt',
         '--refresh_token',
         help='apigee refresh token')
-
+    req_grp.add_argument(
+        '-w',
+        '--workers',
+        help='number of API Products created or updated in parallel - default is 8',
+        type=int,
+        default=8)
+    req_grp.add_argument(
+        '-fo',
+        '--force',
+        help='update the API Products even if they did not change',
+        action='store_true')
 
     parsed = parser.parse_args()
 
     if parsed.refresh_token is None and (parsed.username is None or parsed.password is None):
         parser.error("the following arguments are required: -u/--username and -pwd/--password OR -r/--refresh_token")
 
+    if parsed.file is None and parsed.folder is None and parsed.import_file is None:
+        parser.error("the following arguments are required: -f/--file OR -d/--folder OR -i/--import_file")
+
     return parsed
 
 
@@ -102,12 +168,14 @@ def main():
     """Method called from the main entry point of the script to do the required logic."""
     args = parse_args()
 
-    product_path = args.file
     org_name = args.org
     username = args.username
     password = args.password
     refresh_token = args.refresh_token
 
+    # Read the JSON files containing API Product setup information.
+    products = load_products(args.file, args.folder, args.import_file)
+
     # Retrieve an access token using the refresh token provided. This ensures
     # that we always have a valid access token.
     if refresh_token is not None:
@@ -119,27 +187,25 @@ def main():
     REQUEST.headers.update({'Authorization': 'Bearer {}'.format(access_token)})
     REQUEST.cookies.update({'access_token': access_token})
 
-    # Read JSON file containing API Product setup information.
-    data = open(product_path, 'r', encoding='utf8').read()
-    product = json.loads(data)
-    product_name: str = product['name']
+    # A single product is looked up directly, many are looked up in a listing done once.
+    if len(products) == 1:
+        name = next(iter(products))
+        existing = {name: apigee_api_products.get_api_product(REQUEST, org_name, name)}
+    else:
+        existing = apigee_api_products.list_api_products(REQUEST, org_name)
 
-    # Name is mandatory in the JSON file, otherwise we would not know
-    # whether we want to create or update.
-    if 'name' not in product:
-        raise IOError(
-            print_error('API Product name not specified in JSON file.'))
+    result = utils.run_concurrently(
+        lambda name: sync_api_product(org_name, products[name], existing.get(name), args.force),
+        list(products),
+        args.workers)
+    result.print_summary('Synced')
 
-    exists: bool = product_exists(product_name, org_name)
+    for status in ('created', 'updated', 'unchanged'):
+        count = list(result.succeeded.values()).count(status)
+        print('{} API Product(s) {}.'.format(count, status))
 
-    if exists:
-        print("API Product with name '{}' already exists. Performing an update."
-              .format(product_name))
-        update_api_product(org_name, product)
-    else:
-        print("API Product with name '{}' does not exist. Creating it in Apigee."
-              .format(product_name))
-        create_api_product(org_name, product)
+    if result.failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
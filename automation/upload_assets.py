@@ -1,10 +1,16 @@
 #!/usr/local/bin/python
 """Script which is used to synch all the local assets found in the assets folder with the Apigee portal"""
 import argparse
-import requests
+import fnmatch
+import hashlib
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import requests
 
 from service import apigee_auth, apigee_portal, apigee_assets
+from utils import image_optimizer
+from utils.cache import ContentCache
 
 
 # Global session used for all requests.
@@ -16,25 +22,107 @@ class LocalFile:
     def __init__(self,
                  name: str,
                  path: str,
-                 size: int):
+                 size: int,
+                 digest: str = None):
         self.name = name
         self.path = path
         self.size = size
+        self.digest = digest
+
+
+def matches_patterns(rel_path: str, patterns: []) -> bool:
+    """Checks whether a relative path, or its file name, matches any of the given glob patterns."""
+    file_name = os.path.basename(rel_path)
+    for pattern in patterns:
+        if fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(file_name, pattern):
+            return True
+    return False
+
+
+def find_asset_paths(assets_folder: str, recursive: bool, include: [], exclude: []) -> []:
+    """Lists the paths of all the files in the assets folder which pass the include/exclude rules.
+    Paths are returned relative to the assets folder using '/' as a separator."""
+    rel_paths = []
+
+    for root, dirs, files in os.walk(assets_folder):
+        if not recursive:
+            dirs.clear()
+        # Sorted so that the discovery order is stable between runs.
+        dirs.sort()
+
+        for file_name in sorted(files):
+            rel_path = os.path.relpath(os.path.join(root, file_name), assets_folder).replace(os.sep, '/')
+            if include and not matches_patterns(rel_path, include):
+                continue
+            if exclude and matches_patterns(rel_path, exclude):
+                continue
+            rel_paths.append(rel_path)
 
+    return rel_paths
 
-def get_local_assets(assets_folder: str) -> {}:
-    """Retrieves the all current assets from the asset folder."""
-    entries = os.scandir(assets_folder)
+
+def stat_local_file(path: str) -> LocalFile:
+    """Reads the size and the sha256 digest of a local file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return LocalFile(os.path.basename(path), path, os.path.getsize(path), digest.hexdigest())
+
+
+def get_local_assets(assets_folder: str,
+                     recursive: bool = False,
+                     include: [] = None,
+                     exclude: [] = None,
+                     workers: int = 8) -> {}:
+    """Retrieves the all current assets from the asset folder. Since the portal keeps all
+    the assets in a flat namespace, files found in different sub folders with the same
+    name but a different content are reported as a collision."""
+    rel_paths = find_asset_paths(assets_folder, recursive, include, exclude)
+    paths = [os.path.join(assets_folder, rel_path) for rel_path in rel_paths]
+
+    # Stat and hash the files in parallel, hashing large trees serially dominates the run.
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        stats = list(executor.map(stat_local_file, paths))
 
     local_files = {}
+    found_in = {}
+    collisions = []
+
+    for rel_path, local_file in zip(rel_paths, stats):
+        existing = local_files.get(local_file.name)
+        if existing is None:
+            local_files[local_file.name] = local_file
+            found_in[local_file.name] = rel_path
+        elif existing.digest != local_file.digest:
+            collisions.append('{} ({} and {})'.format(local_file.name, found_in[local_file.name], rel_path))
 
-    for entry in entries:
-        if entry.is_file():
-            local_files[entry.name] = LocalFile(entry.name, entry.path, entry.stat().st_size)
+    if collisions:
+        raise ValueError('Assets with the same name but different content found: '
+                         + ', '.join(collisions))
 
     return local_files
 
 
+def print_dry_run(local_assets: {}, remote_assets: {}, to_upload: [], to_delete: []):
+    """Lists what a real run would upload and delete, with the bytes that would be reclaimed."""
+    for name in to_upload:
+        print('Would upload {} ({} bytes)'.format(local_assets[name].path, local_assets[name].size))
+
+    reclaimed = 0
+    for name in to_delete:
+        try:
+            size = int(remote_assets[name].size)
+        except (TypeError, ValueError):
+            size = 0
+        reclaimed += size
+        print('Would delete {} ({} bytes)'.format(name, size))
+
+    print('{} asset(s) would be uploaded and {} deleted, reclaiming {} bytes.'.format(
+        len(to_upload), len(to_delete), reclaimed))
+
+
 def parse_args():
     """Defines which arguments are needed for the script to run."""
     parser = argparse.ArgumentParser(
@@ -72,12 +160,47 @@ def parse_args():
         '--clean',
         help='clean any unlisted assets',
         action='store_true')
+    req_grp.add_argument(
+        '-d',
+        '--dry_run',
+        help='only list the assets which would be uploaded or deleted',
+        action='store_true')
+    req_grp.add_argument(
+        '-R',
+        '--recursive',
+        help='include assets found in child folders',
+        action='store_true')
+    req_grp.add_argument(
+        '-i',
+        '--include',
+        help='glob pattern of assets to include, can be given multiple times',
+        action='append')
+    req_grp.add_argument(
+        '-x',
+        '--exclude',
+        help='glob pattern of assets to exclude, can be given multiple times',
+        action='append')
+    req_grp.add_argument(
+        '-w',
+        '--workers',
+        help='number of files to hash, or assets to delete, in parallel - default is 8',
+        type=int,
+        default=8)
+    req_grp.add_argument(
+        '-opt',
+        '--optimize',
+        help='losslessly optimize png, jpeg and svg files before uploading them',
+        action='store_true')
+    req_grp.add_argument(
+        '-cd',
+        '--cache_dir',
+        help='folder where optimized files are cached - default is ~/.cache/apigee-automation')
 
     parsed = parser.parse_args()
 
     if parsed.refresh_token is None and (parsed.username is None or parsed.password is None):
         parser.error("the following arguments are required: -u/--username "
-                     "and -pwd/--password OR -r/--refresh_token")
+                     "and -pwd/--password OR -rt/--refresh_token")
 
 
     return parsed
@@ -95,6 +218,10 @@ def main():
     refresh_token = args.refresh_token
     clean = args.clean
 
+    # Scan the local assets first so that name collisions fail before any remote call.
+    local_assets = get_local_assets(assets_folder, args.recursive, args.include,
+                                    args.exclude, args.workers)
+
     # Retrieve an access token using the refresh token provided. This ensures
     # that we always have a valid access token.
     if refresh_token is not None:
@@ -108,24 +235,33 @@ def main():
     # Check portal and add it if not present
     portal = apigee_portal.get_portal(REQUEST, org_name, portal_name)
 
-    # Get remote and local assets
+    # Get remote assets
     remote_assets = apigee_assets.get_remote_assets(REQUEST, portal.id)
-    local_assets = get_local_assets(assets_folder)
 
     #get differences between sets
     to_add = set(local_assets.keys()) - set(remote_assets.keys())
     to_delete = set(remote_assets.keys()) - set(local_assets.keys())
     to_update = set(remote_assets.keys()).intersection(set(local_assets.keys()))
 
-    for add in to_add:
-        apigee_assets.add_remote_asset(REQUEST, portal.id, local_assets[add].path)
+    if args.dry_run:
+        print_dry_run(local_assets, remote_assets, sorted(to_add) + sorted(to_update),
+                      sorted(to_delete) if clean else [])
+        return
+
+    cache = ContentCache('assets', args.cache_dir) if args.optimize else None
+
+    for name in sorted(to_add) + sorted(to_update):
+        path = local_assets[name].path
+        content = image_optimizer.optimize_file(path, cache) if args.optimize else None
+        apigee_assets.add_remote_asset(REQUEST, portal.id, path, content)
 
-    for update in to_update:
-        apigee_assets.add_remote_asset(REQUEST, portal.id, local_assets[update].path)
+    if clean and to_delete:
+        result = apigee_assets.delete_remote_assets(REQUEST, portal.id, org_name,
+                                                    sorted(to_delete), args.workers)
+        result.print_summary('Deleted')
 
-    if clean:
-        for path in to_delete:
-            apigee_assets.delete_remote_asset(REQUEST, portal.id, org_name, path)
+        if result.failed:
+            sys.exit(1)
 
 
 if __name__ == '__main__':
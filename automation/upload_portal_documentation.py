@@ -2,11 +2,14 @@
 """Script which is used to link an API Product to an API spec and expose it on an Apigee Portal."""
 import argparse
 import json
+import os
+import sys
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from service import apigee_auth, apigee_portal
-from utils import utils
+from service import apigee_auth, apigee_portal, apigee_specs
+from utils import openapi, utils
 from exceptions.rest_exception import RestException
 
 
@@ -17,47 +20,85 @@ REQUEST = requests.Session()
 class ApiDoc():
     """Represents an API Portal Documentation."""
 
-    def __init__(self, doc_id: int, spec_name: str, spec_id: str):
+    def __init__(self, doc_id: int, spec_name: str, spec_id: str, data: dict = None):
         self.doc_id = doc_id
         self.spec_name = spec_name
         self.spec_id = spec_id
+        self.data = data or {}
 
 
 def spec_exists(org_name: str, spec_name: str) -> bool:
     """Checks whether a given spec exists inside a given Apigee organization.
        Returns the spec ID if it exists."""
-    response = REQUEST.get(
-        'https://apigee.com/dapi/api/organizations/{}/specs/folder/home'.format(org_name))
+    spec = apigee_specs.get_spec_catalog(REQUEST, org_name).get(spec_name)
+
+    return spec.spec_id if spec else None
+
+
+def get_api_docs_page(portal_name: str, page_size: int, page: int = 0, page_token: str = None) -> {}:
+    """Retrieves a single page of the API documentation exposed on a portal."""
+    url = 'https://apigee.com/portals/api/sites/{}/apidocs?pageSize={}'.format(portal_name, page_size)
+    if page_token:
+        url += '&pageToken={}'.format(page_token)
+    elif page:
+        url += '&page={}'.format(page)
+
+    response = REQUEST.get(url)
 
     if response.status_code != 200:
         raise RestException(utils.print_error(response))
 
-    print('Successfully fetched OpenAPI Specs from Apigee.')
+    return response.json()
 
-    for spec in response.json()['contents']:
-        if spec['name'] == spec_name:
-            return spec['id']
 
-    return None
+def iter_api_docs(portal_name: str, page_size: int, prefetch: bool = False):
+    """Yields all the API documentation exposed on a portal, one page at a time. The next page is
+    requested with the token returned by the previous one, or by page number when there is no token.
+    Paging stops on a partial page, or on a page holding nothing new in case paging is not honoured.
+    With prefetch, the next page is requested while the current one is being consumed."""
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    seen = set()
+    page = 0
+    next_page = None
+
+    try:
+        body = get_api_docs_page(portal_name, page_size)
+        while True:
+            docs = body['data']
+            new_docs = [doc for doc in docs if doc['id'] not in seen]
+            page_token = body.get('nextPageToken')
+            has_more = bool(page_token) or (len(docs) >= page_size and bool(new_docs))
+            page += 1
+
+            if has_more and executor:
+                next_page = executor.submit(get_api_docs_page, portal_name, page_size, page, page_token)
+
+            for doc in new_docs:
+                seen.add(doc['id'])
+                yield doc
+
+            if not has_more:
+                return
+
+            body = next_page.result() if next_page else \
+                get_api_docs_page(portal_name, page_size, page, page_token)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
 
 
 def documentation_exists(
         spec_name: str,
         portal_name: str,
-        page_size: int) -> ApiDoc:
-    """Retrieves a list of API Products exposed on a portal and checks if
-       there is an existing one using the given spec name."""
+        page_size: int,
+        prefetch: bool = False) -> ApiDoc:
+    """Goes through the API documentation exposed on a portal, page by page, and returns the
+       one using the given spec name as soon as it is found."""
 
-    response = REQUEST.get(
-        'https://apigee.com/portals/api/sites/{}/apidocs?pageSize={}'.format(portal_name, page_size))
-
-    if response.status_code != 200:
-        raise RestException(utils.print_error(response))
-
-    for doc in response.json()['data']:
+    for doc in iter_api_docs(portal_name, page_size, prefetch):
         # Spec ID returned by the API is actually the spec name.
         if doc['specId'] == spec_name:
-            return ApiDoc(doc['id'], doc['specId'], doc['specContent'])
+            return ApiDoc(doc['id'], doc['specId'], doc['specContent'], doc)
 
     return None
 
@@ -65,31 +106,36 @@ def documentation_exists(
 def update_api_documentation(
         api_doc: ApiDoc,
         doc: dict,
-        portal_name: str):
+        portal_name: str,
+        snapshot: bool = True,
+        update_doc: bool = True):
     """Updates an existing Portal API Documentation to be in sync with the latest API spec and
-       also includes any changes done in the JSON file."""
+       also includes any changes done in the JSON file. The snapshot of the spec and the update
+       of the documentation itself can each be skipped."""
     print("Updating API documentation on portal '{}' for spec '{}' with doc_id {}".format(
         portal_name,
         api_doc.spec_name,
         api_doc.doc_id))
 
-    response = REQUEST.put(
-        'https://apigee.com/portals/api/sites/{}/apidocs/{}/snapshot'.format(
-            portal_name, api_doc.doc_id))
+    if snapshot:
+        response = REQUEST.put(
+            'https://apigee.com/portals/api/sites/{}/apidocs/{}/snapshot'.format(
+                portal_name, api_doc.doc_id))
 
-    print("snapshot response code: {} and content : {}".format(
-        response.status_code,
-        response.content))
+        print("snapshot response code: {} and content : {}".format(
+            response.status_code,
+            response.content))
 
-    if response.status_code != 200:
-        raise RestException(utils.print_error(response))
+        if response.status_code != 200:
+            raise RestException(utils.print_error(response))
 
-    response = REQUEST.put(
-        'https://apigee.com/portals/api/sites/{}/apidocs/{}'.format(
-            portal_name, api_doc.doc_id), json=doc)
+    if update_doc:
+        response = REQUEST.put(
+            'https://apigee.com/portals/api/sites/{}/apidocs/{}'.format(
+                portal_name, api_doc.doc_id), json=doc)
 
-    if response.status_code != 200:
-        raise RestException(utils.print_error(response))
+        if response.status_code != 200:
+            raise RestException(utils.print_error(response))
 
     print(
         "Successfully updated API documentation on portal '{}' for spec '{}'".format(
@@ -97,6 +143,23 @@ def update_api_documentation(
             api_doc.spec_name))
 
 
+def doc_unchanged(api_doc: ApiDoc, doc: dict) -> bool:
+    """Checks whether every field of the local documentation JSON already has the same value remotely.
+       The organization name is only sent along with the documentation, so it is not compared."""
+    return all(api_doc.data.get(key) == value for key, value in doc.items() if key != 'orgname')
+
+
+def spec_marker(org_name: str, spec_name: str) -> str:
+    """Returns a value which changes whenever the spec changes: its modified date when the
+       spec listing provides it, otherwise the hash of its content."""
+    spec = apigee_specs.get_spec_catalog(REQUEST, org_name).get(spec_name)
+
+    if spec.modified:
+        return str(spec.modified)
+
+    return openapi.normalized_spec_hash(apigee_specs.get_spec_content(REQUEST, org_name, spec.spec_id))
+
+
 def create_api_documentation(doc: dict, portal_name: str):
     """Creates documentation in the given Apigee API Portal
        with the specified details in the JSON file."""
@@ -120,6 +183,83 @@ def create_api_documentation(doc: dict, portal_name: str):
             spec_id))
 
 
+def index_api_docs(portal_name: str, page_size: int, prefetch: bool = False) -> {}:
+    """Lists all the API documentation exposed on a portal once and indexes it by spec name."""
+    api_docs = {}
+
+    for doc in iter_api_docs(portal_name, page_size, prefetch):
+        # Spec ID returned by the API is actually the spec name.
+        api_docs.setdefault(doc['specId'], ApiDoc(doc['id'], doc['specId'], doc['specContent'], doc))
+
+    return api_docs
+
+
+def sync_api_documentation(doc: dict, api_doc: ApiDoc, portal_name: str,
+                           snapshots: {} = None, marker: str = None) -> str:
+    """Creates the API documentation, or updates it if it already exists. When the spec marker
+       is the same as the one the documentation was last snapshotted from, according to
+       snapshots, the snapshot is skipped. The documentation itself is only updated if it
+       differs from the remote one. Returns whether the documentation was 'created',
+       'updated' or 'unchanged'."""
+    snapshots = {} if snapshots is None else snapshots
+
+    if not api_doc:
+        print("API Doc for spec '{}' does not currently exist.".format(doc['specId']))
+        create_api_documentation(doc, portal_name)
+        snapshots[doc['specId']] = marker
+        return 'created'
+
+    print("API Doc for spec '{}' already exists.".format(doc['specId']))
+
+    snapshot = marker is None or snapshots.get(doc['specId']) != marker
+    update_doc = not doc_unchanged(api_doc, doc)
+
+    if not snapshot and not update_doc:
+        print("API Doc for spec '{}' is unchanged, skipping update.".format(doc['specId']))
+        return 'unchanged'
+
+    try:
+        update_api_documentation(api_doc, doc, portal_name, snapshot, update_doc)
+    except RestException:
+        # Retry since this call fails intermittently
+        print("First put call failed ... retrying")
+        time.sleep(5)
+        update_api_documentation(api_doc, doc, portal_name, snapshot, update_doc)
+
+    snapshots[doc['specId']] = marker
+    return 'updated'
+
+
+def load_docs_to_sync(doc_path: str, spec_name: str, spec_file: str, manifest: str, org_name: str) -> {}:
+    """Reads the documentation JSON files to sync, by spec name, together with the optional
+    local spec files. Relative paths in a manifest are resolved against the manifest's location."""
+    entries = []
+
+    if doc_path:
+        entries.append((doc_path, spec_name, spec_file))
+
+    if manifest:
+        base = os.path.dirname(manifest)
+        with open(manifest, 'r', encoding='utf8') as file:
+            for item in json.load(file):
+                entries.append((os.path.join(base, item['file']),
+                                item['spec_name'],
+                                os.path.join(base, item['spec_file']) if item.get('spec_file') else None))
+
+    docs = {}
+    for path, name, local_spec in entries:
+        with open(path, 'r', encoding='utf8') as file:
+            doc = json.load(file)
+
+        # Organization name might change according to the environment. so update the json
+        # with the organization name given as an argument. Spec name also needs to be provided
+        # as an argument for ease of use when using this script along with upload_spec.py.
+        doc.update({'orgname': org_name, 'specId': name})
+        docs[name] = (doc, local_spec)
+
+    return docs
+
+
 def parse_args():
     """Defines which arguments are needed for the script to run."""
     parser = argparse.ArgumentParser(
@@ -128,13 +268,15 @@ def parse_args():
     req_grp.add_argument(
         '-f',
         '--file',
-        help='path of the Portal documentation JSON file',
-        required=True)
+        help='path of the Portal documentation JSON file')
     req_grp.add_argument(
         '-s',
         '--spec_name',
-        help='name of the OpenAPI Spec',
-        required=True)
+        help='name of the OpenAPI Spec')
+    req_grp.add_argument(
+        '-m',
+        '--manifest',
+        help='path of a JSON file listing many documentation files to sync, with their spec names')
     req_grp.add_argument(
         '-p',
         '--portal',
@@ -160,13 +302,40 @@ def parse_args():
     req_grp.add_argument(
         '-pgs',
         '--page_size',
-        help='page size for API calls that use paging - default is 100')
+        help='page size for API calls that use paging - default is 100',
+        type=int)
+    req_grp.add_argument(
+        '-pf',
+        '--prefetch',
+        help='request the next page of API documentation while scanning the current one',
+        action='store_true')
+    req_grp.add_argument(
+        '-sf',
+        '--spec_file',
+        help='path of the local OpenAPI Spec file, validated before anything is changed on Apigee')
+    req_grp.add_argument(
+        '-w',
+        '--workers',
+        help='number of API documentation synced in parallel - default is 8',
+        type=int,
+        default=8)
+    req_grp.add_argument(
+        '-st',
+        '--state_file',
+        help='path of a JSON file remembering which spec version each documentation was last '
+             'snapshotted from, to skip snapshots of unchanged specs')
 
     parsed = parser.parse_args()
 
     if parsed.refresh_token is None and (parsed.username is None or parsed.password is None):
         parser.error("the following arguments are required: -u/--username and -pwd/--password OR -r/--refresh_token")
 
+    if (parsed.file is None) != (parsed.spec_name is None):
+        parser.error("-f/--file and -s/--spec_name must be given together")
+
+    if parsed.file is None and parsed.manifest is None:
+        parser.error("the following arguments are required: -f/--file and -s/--spec_name OR -m/--manifest")
+
     return parsed
 
 
@@ -174,8 +343,6 @@ def main():
     """Method called from the main entry point of the script to do the required logic."""
     args = parse_args()
 
-    doc_path = args.file
-    spec_name = args.spec_name
     portal = args.portal
     org_name = args.org
     username = args.username
@@ -185,13 +352,14 @@ def main():
     # Some API calls make use of paging, if the page size is not defined, we default it to 100.
     page_size = 100 if args.page_size is None else args.page_size
 
-    data = open(doc_path, 'r', encoding='utf8').read()
-    doc = json.loads(data)
+    docs = load_docs_to_sync(args.file, args.spec_name, args.spec_file, args.manifest, org_name)
 
-    # Organization name might change according to the environment. so update the json
-    # with the organization name given as an argument. Spec name also needs to be provided
-    # as an argument for ease of use when using this script along with upload_spec.py.
-    doc.update({'orgname': org_name, 'specId': spec_name})
+    # Fail before any remote call if a spec the documentation is based on is not valid.
+    spec_files = [spec_file for _, spec_file in docs.values() if spec_file]
+    failures = openapi.preflight_specs(spec_files)
+    if failures:
+        sys.exit('\n'.join('Invalid spec {}:\n - {}'.format(path, '\n - '.join(errors))
+                           for path, errors in failures.items()))
 
     # Retrieve an access token using the refresh token provided. This ensures
     # that we always have a valid access token.
@@ -208,29 +376,41 @@ def main():
 
     # We do not want to create portal documentation if the spec given does not
     # exist on Apigee.
-    spec_id = spec_exists(org_name, spec_name)
-    if not spec_id:
-        raise RestException(
-            "Spec with name '{}' does not exist in Apigee.".format(spec_name))
-
-    # Spec IDs might change all the time, and we use the name as our ID.
-    # Therefore, use the spec name specified in the JSON file and fetch
-    # the spec ID dynamically.
-    doc.update({'specContent': spec_id})
-
-    api_doc = documentation_exists(spec_name, current_portal.id, page_size)
-    if api_doc:
-        print("API Doc already exists.")
-        try:
-            update_api_documentation(api_doc, doc, current_portal.id)
-        except RestException:
-            # Retry since this call fails intermittently
-            print("First put call failed ... retrying")
-            time.sleep(5)
-            update_api_documentation(api_doc, doc, current_portal.id)
+    for spec_name, (doc, _) in docs.items():
+        spec_id = spec_exists(org_name, spec_name)
+        if not spec_id:
+            raise RestException(
+                "Spec with name '{}' does not exist in Apigee.".format(spec_name))
+
+        # Spec IDs might change all the time, and we use the name as our ID.
+        # Therefore, use the spec name specified in the JSON file and fetch
+        # the spec ID dynamically.
+        doc.update({'specContent': spec_id})
+
+    # A single documentation is looked up page by page until found, many are
+    # looked up in a listing of all the documentation done once.
+    if len(docs) == 1:
+        spec_name = next(iter(docs))
+        api_docs = {spec_name: documentation_exists(spec_name, current_portal.id, page_size, args.prefetch)}
     else:
-        print("API Doc does not currently exist.")
-        create_api_documentation(doc, current_portal.id)
+        api_docs = index_api_docs(current_portal.id, page_size, args.prefetch)
+
+    # Without a state file there is nothing to compare with, so specs are always snapshotted.
+    state = utils.load_state(args.state_file)
+    snapshots = state.setdefault(current_portal.id, {})
+
+    def sync(spec_name: str) -> str:
+        marker = spec_marker(org_name, spec_name) if args.state_file else None
+        return sync_api_documentation(docs[spec_name][0], api_docs.get(spec_name),
+                                      current_portal.id, snapshots, marker)
+
+    result = utils.run_concurrently(sync, list(docs), args.workers)
+
+    utils.save_state(args.state_file, state)
+    result.print_summary('Synced')
+
+    if result.failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -4,6 +4,8 @@ import argparse
 import requests
 
 from service import apigee_auth, apigee_portal, apigee_assets
+from utils import image_optimizer
+from utils.cache import ContentCache
 
 # Global session used for all requests.
 REQUEST = requests.Session()
@@ -41,6 +43,15 @@ def parse_args():
         '-rt',
         '--refresh_token',
         help='apigee refresh token')
+    req_grp.add_argument(
+        '-opt',
+        '--optimize',
+        help='losslessly optimize png, jpeg and svg files before uploading them',
+        action='store_true')
+    req_grp.add_argument(
+        '-cd',
+        '--cache_dir',
+        help='folder where optimized files are cached - default is ~/.cache/apigee-automation')
 
     parsed = parser.parse_args()
 
@@ -74,7 +85,12 @@ def main():
 
     # Check portal and add it if not present
     portal = apigee_portal.get_portal(REQUEST, org_name, portal_name)
-    apigee_assets.add_remote_asset(REQUEST, portal.id, file)
+
+    content = None
+    if args.optimize:
+        content = image_optimizer.optimize_file(file, ContentCache('assets', args.cache_dir))
+
+    apigee_assets.add_remote_asset(REQUEST, portal.id, file, content)
 
 
 if __name__ == '__main__':
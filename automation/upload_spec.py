@@ -2,67 +2,26 @@
 """Script which is used to upload an OpenAPI spec to Apigee."""
 
 import argparse
+import json
+import os
+import sys
 
 import requests
 
-from service import apigee_auth
+from service import apigee_auth, apigee_specs
+from utils import openapi, utils
+from utils.cache import ContentCache
 
 # Global session used for all requests.
 REQUEST = requests.Session()
 
 
-class Spec:
-    """Class containing details of an Apigee OpenAPI spec."""
-
-    def __init__(self, name: str, spec_id: str, folder_id: int):
-        self.name = name
-        self.spec_id = spec_id
-        self.folder_id = folder_id
-
-
-class Folder:
-    """Class containing a details of an Apigee folder holding 0+ OpenAPI specs."""
-
-    def __init__(self, folder_id: str, specs: []):
-        self.folder_id = folder_id
-        self.specs = specs
-
-
 def print_error(response) -> str:
     """Prints the error returned from an API call"""
     return 'Error: {}. \n {}'.format(response.status_code, response.json())
 
 
-def get_specs_folder(org_name: str) -> Folder:
-    """Retrieves the spec folder of the given organization name together
-    with the details of the specs if any."""
-    response = REQUEST.get(
-        'https://apigee.com/dapi/api/organizations/{}/specs/folder/home'.format(org_name))
-
-    if response.status_code != 200:
-        print_error(response)
-        raise response.raise_for_status()
-
-    print('Successfully fetched OpenAPI Specs folder from Apigee.')
-
-    specs = []
-    json = response.json()
-
-    for spec in json['contents']:
-        specs.append(Spec(spec['name'], spec['id'], spec['folder']))
-
-    return Folder(json['id'], specs)
-
-
-def spec_exists(spec_name, specs) -> Spec:
-    """Checks whether a given spec name already exists in the list of given specs."""
-    for spec in specs:
-        if spec.name == spec_name:
-            return spec
-    return None
-
-
-def create_empty_spec(org_name: str, folder_id: int, spec_name: str) -> Spec:
+def create_empty_spec(org_name: str, folder_id: int, spec_name: str) -> apigee_specs.Spec:
     """Creates an empty spec file inside Apigee with the given name inside the given folder ID
     for the specified organization name."""
     url = 'https://apigee.com/dapi/api/organizations/{}/specs/doc'.format(
@@ -78,22 +37,20 @@ def create_empty_spec(org_name: str, folder_id: int, spec_name: str) -> Spec:
         print_error(response)
         raise response.raise_for_status()
 
-    json = response.json()
+    body = response.json()
     print(
         'Successfully created empty OpenAPI spec in Apigee with name: {} and id: {}'.format(
-            json['name'],
-            json['id']))
-    return Spec(json['name'], json['id'], json['folder'])
+            body['name'],
+            body['id']))
+    return apigee_specs.Spec(body['name'], body['id'], body['folder'])
 
 
 def update_spec(org_name: str, spec_id: int, spec_path: str):
-    """Updates an existing spec file."""
+    """Updates an existing spec file. The file is streamed from disk rather than loaded in memory."""
     url = 'https://apigee.com/dapi/api/organizations/{}/specs/doc/{}/content'.format(
         org_name, spec_id)
-    with open(spec_path, 'r', encoding='utf8') as file:
-        data = file.read()
 
-    response = REQUEST.put(url, data=data.encode('utf-8'))
+    response = REQUEST.put(url, data=utils.Utf8FileStream(spec_path))
     if response.status_code != 200:
         print_error(response)
         raise response.raise_for_status()
@@ -101,6 +58,94 @@ def update_spec(org_name: str, spec_id: int, spec_path: str):
     print('Successfully uploaded OpenAPI spec to Apigee!')
 
 
+def load_specs_to_upload(spec_name: str, spec_path: str, folder: str, manifest: str) -> {}:
+    """Builds the mapping of spec name to local file to upload. Specs found in a folder are
+    named after their file name without the extension. Relative paths in a manifest are
+    resolved against the manifest's location."""
+    specs = {}
+
+    if spec_name:
+        specs[spec_name] = spec_path
+
+    if folder:
+        for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+            name, extension = os.path.splitext(entry.name)
+            if entry.is_file() and extension.lower() in ('.yaml', '.yml', '.json'):
+                specs[name] = entry.path
+
+    if manifest:
+        with open(manifest, 'r', encoding='utf8') as file:
+            for name, path in json.load(file).items():
+                specs[name] = os.path.join(os.path.dirname(manifest), path)
+
+    return specs
+
+
+def upload_spec(org_name: str, catalog: apigee_specs.SpecCatalog, state: {},
+                spec_name: str, spec_path: str, force: bool = False) -> str:
+    """Creates the spec if it does not exist yet and fills it with the content of the local file.
+    Unless forced, the upload is skipped if the remote content is the same as the local one, either
+    according to the state kept from previous runs or by comparing it with the remote content.
+    Returns whether the spec was 'created', 'updated' or 'unchanged'."""
+    spec = catalog.get(spec_name)
+
+    with open(spec_path, 'rb') as file:
+        local_hash = openapi.normalized_spec_hash(file.read())
+
+    # Create a new file for the OpenApi spec on Apigee if there isn't an
+    # existing one.
+    if not spec:
+        print("Spec '{}' does not exist - creating it on Apigee".format(spec_name))
+        spec = create_empty_spec(org_name, catalog.home_folder_id, spec_name)
+        catalog.add(spec)
+        status = 'created'
+    elif force:
+        status = 'updated'
+    else:
+        remote_hash = state.get(str(spec.spec_id))
+        if remote_hash is None:
+            remote_hash = openapi.normalized_spec_hash(
+                apigee_specs.get_spec_content(REQUEST, org_name, spec.spec_id))
+
+        if remote_hash == local_hash:
+            print("Spec '{}' is unchanged, skipping upload.".format(spec_name))
+            state[str(spec.spec_id)] = local_hash
+            return 'unchanged'
+        status = 'updated'
+
+    # Fill the file with the OpenAPI spec.
+    update_spec(org_name, spec.spec_id, spec_path)
+    state[str(spec.spec_id)] = local_hash
+
+    return status
+
+
+def bundle_specs(specs_to_upload: {}, output_format: str, cache_dir: str) -> {}:
+    """Bundles every spec into a single compact file and returns the paths of the bundled specs."""
+    cache = ContentCache('specs', cache_dir)
+    bundled = {}
+
+    for name, path in specs_to_upload.items():
+        bundled[name] = openapi.bundle_spec_file(path, output_format, cache)
+        print("Bundled spec '{}': {} bytes -> {} bytes.".format(
+            name, os.path.getsize(path), os.path.getsize(bundled[name])))
+
+    return bundled
+
+
+def check_specs(spec_paths: [], cache_dir: str):
+    """Validates all the specs in parallel and stops the script if any of them is not valid."""
+    failures = openapi.preflight_specs(spec_paths, cache_dir)
+
+    for path, errors in failures.items():
+        print('Invalid spec {}:'.format(path))
+        for error in errors:
+            print(' - {}'.format(error))
+
+    if failures:
+        sys.exit('{} spec(s) failed validation, nothing was uploaded.'.format(len(failures)))
+
+
 def parse_args():
     """Defines which arguments are needed for the script to run."""
     parser = argparse.ArgumentParser(
@@ -109,13 +154,19 @@ def parse_args():
     req_grp.add_argument(
         '-n',
         '--name',
-        help='name of the OpenAPI Spec',
-        required=True)
+        help='name of the OpenAPI Spec')
     req_grp.add_argument(
         '-f',
         '--file',
-        help='path of the OpenAPI Spec yaml file',
-        required=True)
+        help='path of the OpenAPI Spec yaml file')
+    req_grp.add_argument(
+        '-d',
+        '--folder',
+        help='path of a folder of OpenAPI Specs to upload, named after their file names')
+    req_grp.add_argument(
+        '-m',
+        '--manifest',
+        help='path of a JSON file mapping OpenAPI Spec names to the files to upload')
     req_grp.add_argument(
         '-o',
         '--org',
@@ -133,12 +184,56 @@ def parse_args():
         '-rt',
         '--refresh_token',
         help='apigee refresh token')
+    req_grp.add_argument(
+        '-w',
+        '--workers',
+        help='number of specs uploaded in parallel - default is 8',
+        type=int,
+        default=8)
+    req_grp.add_argument(
+        '-s',
+        '--state_file',
+        help='path of a JSON file remembering the uploaded specs, to skip unchanged specs '
+             'without downloading them')
+    req_grp.add_argument(
+        '-fo',
+        '--force',
+        help='upload the specs even if they did not change',
+        action='store_true')
+    req_grp.add_argument(
+        '-b',
+        '--bundle',
+        help='inline the $refs to other local files, drop unused components and upload a compact spec',
+        action='store_true')
+    req_grp.add_argument(
+        '-bf',
+        '--bundle_format',
+        help='format of the bundled specs - default is json',
+        choices=['json', 'yaml'],
+        default='json')
+    req_grp.add_argument(
+        '-cd',
+        '--cache_dir',
+        help='folder where bundled specs and validation results are cached - '
+             'default is ~/.cache/apigee-automation')
+    req_grp.add_argument(
+        '-nv',
+        '--no_validation',
+        help='do not validate the specs before uploading them',
+        action='store_true')
 
     parsed = parser.parse_args()
 
     if parsed.refresh_token is None and (parsed.username is None or parsed.password is None):
         parser.error("the following arguments are required: -u/--username and -pwd/--password OR -r/--refresh_token")
 
+    if (parsed.name is None) != (parsed.file is None):
+        parser.error("-n/--name and -f/--file must be given together")
+
+    if parsed.name is None and parsed.folder is None and parsed.manifest is None:
+        parser.error("the following arguments are required: -n/--name and -f/--file "
+                     "OR -d/--folder OR -m/--manifest")
+
     return parsed
 
 
@@ -146,13 +241,23 @@ def main():
     """Method called from the main entry point of the script to do the required logic."""
     args = parse_args()
 
-    spec_name = args.name
-    spec_path = args.file
     org_name = args.org
     username = args.username
     password = args.password
     refresh_token = args.refresh_token
 
+    specs_to_upload = load_specs_to_upload(args.name, args.file, args.folder, args.manifest)
+
+    # Bundle the specs before logging in so that broken references fail straight away.
+    if args.bundle:
+        try:
+            specs_to_upload = bundle_specs(specs_to_upload, args.bundle_format, args.cache_dir)
+        except ValueError as error:
+            sys.exit(str(error))
+
+    if not args.no_validation:
+        check_specs(specs_to_upload.values(), args.cache_dir)
+
     # Retrieve an access token using the refresh token provided. This ensures
     # that we always have a valid access token.
     if refresh_token is not None:
@@ -162,20 +267,26 @@ def main():
 
     apigee_auth.set_headers(REQUEST, access_token, org_name)
 
-    # Retrieve all the API specs
-    folder = get_specs_folder(org_name)
+    # Retrieve all the API specs once, and index them by name.
+    catalog = apigee_specs.get_spec_catalog(REQUEST, org_name, args.workers)
 
-    # Check if there already is an OpenAPI spec with the same name.
-    spec = spec_exists(spec_name, folder.specs)
+    state = utils.load_state(args.state_file)
 
-    # Create a new file for the OpenApi spec on Apigee if there isn't an
-    # existing one.
-    if not spec:
-        print('Spec does not exist - creating it on Apigee')
-        spec = create_empty_spec(org_name, folder.folder_id, spec_name)
+    result = utils.run_concurrently(
+        lambda name: upload_spec(org_name, catalog, state, name,
+                                 specs_to_upload[name], args.force),
+        list(specs_to_upload),
+        args.workers)
 
-    # Fill the file with the OpenAPI spec.
-    update_spec(org_name, spec.spec_id, spec_path)
+    utils.save_state(args.state_file, state)
+    result.print_summary('Processed')
+
+    for status in ('created', 'updated', 'unchanged'):
+        count = list(result.succeeded.values()).count(status)
+        print('{} spec(s) {}.'.format(count, status))
+
+    if result.failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
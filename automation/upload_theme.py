@@ -3,17 +3,25 @@
 import argparse
 import json
 import base64
+import hashlib
+import sys
 import requests
 
 from service import apigee_auth, apigee_customcss, apigee_portal
+from utils import scss
+from utils.cache import ContentCache
 
 
 # Global session used for all requests.
 REQUEST = requests.Session()
 
+THEME_FIELDS = apigee_customcss.TEXT_FIELDS + apigee_customcss.IMAGE_FIELDS
 
-def load_local_theme(theme_config_filename: str) -> apigee_customcss.Theme:
-    """Retrieves the current theme settings for the current portal."""
+
+def load_local_theme(theme_config_filename: str, minify: bool = False,
+                     cache_dir: str = None) -> apigee_customcss.Theme:
+    """Retrieves the current theme settings for the current portal. The SCSS files are
+    validated locally, and optionally minified, so that broken themes fail before any upload."""
     data = open(theme_config_filename, 'r', encoding='utf8').read()
     config = json.loads(data)
 
@@ -23,11 +31,15 @@ def load_local_theme(theme_config_filename: str) -> apigee_customcss.Theme:
     mobile_logo = ''
     favicon = ''
 
+    cache = ContentCache('scss', cache_dir)
+
     if config['overridesFile']:
         variable_overrides = open(config['overridesFile'], 'r', encoding='utf8').read()
+        variable_overrides = scss.prepare_scss(variable_overrides, config['overridesFile'], minify, cache)
 
     if config['customScssFile']:
         custom_css = open(config['customScssFile'], 'r', encoding='utf8').read()
+        custom_css = scss.prepare_scss(custom_css, config['customScssFile'], minify, cache)
 
     if config['logoFile']:
         with open(config['logoFile'], "rb") as image_file:
@@ -50,6 +62,69 @@ def load_local_theme(theme_config_filename: str) -> apigee_customcss.Theme:
                                   favicon)
 
 
+def normalize_scss(text: str) -> str:
+    """Normalizes line endings and trailing whitespace so that only real changes are detected."""
+    if not text:
+        return ''
+    lines = [line.rstrip() for line in text.replace('\r\n', '\n').split('\n')]
+    return '\n'.join(lines).strip()
+
+
+def normalize_variables(variables: str) -> str:
+    """Normalizes the JSON holding the theme variables."""
+    try:
+        return json.dumps(json.loads(variables), sort_keys=True)
+    except (TypeError, ValueError):
+        return variables or ''
+
+
+def get_published_image(url: str) -> bytes:
+    """Downloads a published theme image, None if it can't be fetched."""
+    if not url or not url.startswith('http'):
+        return None
+
+    # Published images are public, so the authenticated session is not used.
+    try:
+        response = requests.get(url, timeout=30)
+    except requests.RequestException:
+        return None
+
+    if response.status_code != 200:
+        return None
+
+    return response.content
+
+
+def published_image_digest(url: str) -> str:
+    """Downloads a published theme image and returns its sha256 digest, None if it can't be fetched."""
+    image = get_published_image(url)
+    return hashlib.sha256(image).hexdigest() if image is not None else None
+
+
+def diff_theme(local: apigee_customcss.Theme, published: apigee_customcss.Theme, fields: []) -> []:
+    """Returns which of the given fields of the local theme differ from the published theme."""
+    changed = []
+
+    for field in fields:
+        local_value = getattr(local, field)
+        published_value = getattr(published, field)
+
+        if field == 'variables':
+            same = normalize_variables(local_value) == normalize_variables(published_value)
+        elif field in apigee_customcss.TEXT_FIELDS:
+            same = normalize_scss(local_value) == normalize_scss(published_value)
+        elif not local_value:
+            same = not published_value
+        else:
+            local_digest = hashlib.sha256(base64.b64decode(local_value)).hexdigest()
+            same = local_digest == published_image_digest(published_value)
+
+        if not same:
+            changed.append(field)
+
+    return changed
+
+
 def parse_args():
     """Defines which arguments are needed for the script to run."""
     parser = argparse.ArgumentParser(
@@ -82,12 +157,37 @@ def parse_args():
         '-rt',
         '--refresh_token',
         help='apigee refresh token')
+    req_grp.add_argument(
+        '-fl',
+        '--fields',
+        help='comma separated theme fields to update, any of: ' + ', '.join(THEME_FIELDS)
+             + ' - default is all')
+    req_grp.add_argument(
+        '-fo',
+        '--force',
+        help='update and publish the theme even if it is the same as the published one',
+        action='store_true')
+    req_grp.add_argument(
+        '-m',
+        '--minify',
+        help='send minified SCSS to the portal',
+        action='store_true')
+    req_grp.add_argument(
+        '-cd',
+        '--cache_dir',
+        help='folder where SCSS validation results are cached - default is ~/.cache/apigee-automation')
 
     parsed = parser.parse_args()
 
     if parsed.refresh_token is None and (parsed.username is None or parsed.password is None):
         parser.error("the following arguments are required: -u/--username and -pwd/--password OR -r/--refresh_token")
 
+    if parsed.fields is not None:
+        parsed.fields = [field.strip() for field in parsed.fields.split(',') if field.strip()]
+        unknown = [field for field in parsed.fields if field not in THEME_FIELDS]
+        if unknown:
+            parser.error("unknown theme fields: {}".format(', '.join(unknown)))
+
     return parsed
 
 
@@ -102,6 +202,12 @@ def main():
     password = args.password
     refresh_token = args.refresh_token
 
+    # Load and validate the local theme before anything is sent to Apigee.
+    try:
+        new_theme = load_local_theme(configuration_path, args.minify, args.cache_dir)
+    except ValueError as error:
+        sys.exit(str(error))
+
     # Retrieve an access token using the refresh token provided. This ensures
     # that we always have a valid access token.
     if refresh_token is not None:
@@ -115,11 +221,35 @@ def main():
     # Check portal and add it if not present
     portal = apigee_portal.get_portal(REQUEST, org_name, portal_name)
 
-    new_theme = load_local_theme(configuration_path)
+    if new_theme is None:
+        return
+
+    fields = args.fields if args.fields is not None else THEME_FIELDS
+    published = apigee_customcss.get_current_theme(REQUEST, portal.id)
+
+    changed = fields if args.force else diff_theme(new_theme, published, fields)
+
+    if not changed:
+        print('Theme is the same as the published one, skipping update and publish.')
+        return
+
+    print('Theme fields to update: {}'.format(', '.join(changed)))
+
+    # The whole theme is always sent as the update replaces it. Fields which are not being updated
+    # keep their published value, published images being downloaded to be sent back as they are.
+    for field in THEME_FIELDS:
+        if field in fields:
+            continue
+        published_value = getattr(published, field)
+        if field in apigee_customcss.IMAGE_FIELDS and published_value:
+            image = get_published_image(published_value)
+            if image is None:
+                sys.exit('Could not fetch the published {} to keep it, aborting the update.'.format(field))
+            published_value = base64.b64encode(image).decode('utf-8')
+        setattr(new_theme, field, published_value or '')
 
-    if new_theme is not None:
-        apigee_customcss.update_theme(REQUEST, portal.id, new_theme)
-        apigee_customcss.publish_theme(REQUEST, portal.id, org_name)
+    apigee_customcss.update_theme(REQUEST, portal.id, new_theme)
+    apigee_customcss.publish_theme(REQUEST, portal.id, org_name)
 
 
 if __name__ == '__main__':
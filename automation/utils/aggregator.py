@@ -0,0 +1,222 @@
+#!/usr/local/bin/python
+"""Streaming aggregation of the gzipped CSV results of analytics reports. Rows are read in batches
+and only per group statistics are kept, so memory does not grow with the size of the report.
+Batches are vectorized with NumPy when it is installed and requested."""
+import csv
+import gzip
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ValueSketch:
+    """Approximate distribution of a metric: values are counted in logarithmic buckets so that
+    any percentile is known within the relative accuracy, whatever the number of values."""
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # Bucket counts by (sign, index), a bucket holding the values in (gamma^(index-1), gamma^index].
+        self.buckets = {}
+        self.count = 0
+
+    def key(self, value: float) -> tuple:
+        """Bucket of a single value."""
+        if value == 0:
+            return 0, 0
+        return (1 if value > 0 else -1), math.ceil(math.log(abs(value)) / self.log_gamma)
+
+    def add(self, value: float, count: int = 1):
+        """Counts a value."""
+        key = self.key(value)
+        self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += count
+
+    def add_bucket(self, key: tuple, count: int):
+        """Counts values already assigned to a bucket, as returned by key."""
+        self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += count
+
+    def value_of(self, key: tuple) -> float:
+        """Value representing a bucket, within the relative accuracy of all the values it holds."""
+        sign, index = key
+        if sign == 0:
+            return 0.0
+        return sign * 2 * self.gamma ** index / (self.gamma + 1)
+
+    def percentile(self, percent: float) -> float:
+        """Returns the approximate percentile (0-100) of the values, None if there are none."""
+        if not self.count:
+            return None
+
+        # Buckets ordered by value: negative ones from the largest index, then zero, then positive ones.
+        ordered = sorted(self.buckets, key=lambda key: (key[0], key[1] * key[0]))
+        rank = percent / 100 * (self.count - 1)
+        seen = 0
+        for key in ordered:
+            seen += self.buckets[key]
+            if seen > rank:
+                return self.value_of(key)
+        return self.value_of(ordered[-1])
+
+
+class GroupStats:
+    """Count of rows, and sum and distribution of every metric, for one group."""
+
+    def __init__(self, metrics: [], relative_accuracy: float):
+        self.count = 0
+        self.sums = {metric: 0.0 for metric in metrics}
+        self.sketches = {metric: ValueSketch(relative_accuracy) for metric in metrics}
+
+
+class ReportAggregator:
+    """Groups the rows of a report by some dimensions, computing the row count and the sums and
+    percentiles of some metrics per group. Empty or non numeric metric values are ignored."""
+
+    def __init__(self, group_by: [], metrics: [], percentiles: [] = None, relative_accuracy: float = 0.01):
+        self.group_by = list(group_by)
+        self.metrics = list(metrics)
+        self.percentiles = list(percentiles) if percentiles is not None else [50, 90, 99]
+        self.relative_accuracy = relative_accuracy
+        self.groups = {}
+
+    def group(self, key: tuple) -> GroupStats:
+        """Statistics of a group, created on first use."""
+        stats = self.groups.get(key)
+        if stats is None:
+            stats = self.groups[key] = GroupStats(self.metrics, self.relative_accuracy)
+        return stats
+
+    def add_batch(self, keys: [], columns: {}):
+        """Adds a batch of rows given as their group keys and the raw values of every metric."""
+        for index, key in enumerate(keys):
+            stats = self.group(key)
+            stats.count += 1
+            for metric in self.metrics:
+                value = to_number(columns[metric][index])
+                if not math.isnan(value):
+                    stats.sums[metric] += value
+                    stats.sketches[metric].add(value)
+
+    def add_batch_numpy(self, keys: [], columns: {}):
+        """Same as add_batch, with the sums and bucket counts computed with NumPy."""
+        group_keys = list(dict.fromkeys(keys))
+        group_ids = {key: group_id for group_id, key in enumerate(group_keys)}
+        ids = numpy.fromiter((group_ids[key] for key in keys), dtype=numpy.int64, count=len(keys))
+        groups = [self.group(key) for key in group_keys]
+
+        for group_id, count in enumerate(numpy.bincount(ids, minlength=len(groups))):
+            groups[group_id].count += int(count)
+
+        for metric in self.metrics:
+            values = numpy.array([to_number(value) for value in columns[metric]], dtype=numpy.float64)
+            valid = ~numpy.isnan(values)
+            metric_ids = ids[valid]
+            values = values[valid]
+
+            sums = numpy.bincount(metric_ids, weights=values, minlength=len(groups))
+            for group_id, total in enumerate(sums):
+                groups[group_id].sums[metric] += float(total)
+
+            log_gamma = groups[0].sketches[metric].log_gamma if groups else 1
+            signs = numpy.sign(values).astype(numpy.int64)
+            with numpy.errstate(divide='ignore'):
+                indexes = numpy.ceil(numpy.log(numpy.abs(values)) / log_gamma)
+            indexes = numpy.where(signs == 0, 0, indexes).astype(numpy.int64)
+
+            buckets, counts = numpy.unique(numpy.stack([metric_ids, signs, indexes]), axis=1, return_counts=True)
+            for (group_id, sign, index), count in zip(buckets.T.tolist(), counts.tolist()):
+                groups[group_id].sketches[metric].add_bucket((sign, index), count)
+
+    def summary_header(self) -> []:
+        """Columns of the summary rows."""
+        header = self.group_by + ['count']
+        for metric in self.metrics:
+            header.append('sum({})'.format(metric))
+            header.extend('p{}({})'.format(format_percent(percent), metric) for percent in self.percentiles)
+        return header
+
+    def summary_rows(self):
+        """Yields one summary row per group, ordered by group."""
+        for key in sorted(self.groups):
+            stats = self.groups[key]
+            row = list(key) + [stats.count]
+            for metric in self.metrics:
+                row.append(format_number(stats.sums[metric]))
+                row.extend(format_number(stats.sketches[metric].percentile(percent))
+                           for percent in self.percentiles)
+            yield row
+
+
+def to_number(value: str) -> float:
+    """Parses a metric value, NaN when it is empty or not a number."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return number if math.isfinite(number) else math.nan
+
+
+def format_percent(percent: float) -> str:
+    """Formats 99.0 as '99' and 99.9 as '99.9'."""
+    return '{:g}'.format(percent)
+
+
+def format_number(value: float) -> str:
+    """Formats a summary value compactly, an empty string when there is none."""
+    if value is None:
+        return ''
+    return '{:.6g}'.format(value) if value != int(value) or abs(value) >= 1e15 else str(int(value))
+
+
+def open_csv(path: str, mode: str):
+    """Opens a CSV file, gzipped if its name ends with .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def aggregate_csv(path: str, aggregator: ReportAggregator, batch_size: int = 10000, use_numpy: bool = False) -> int:
+    """Reads a report CSV in batches of rows and feeds them to the aggregator.
+    Raises a ValueError if a dimension or metric is not a column of the report. Returns the number of rows."""
+    use_numpy = use_numpy and numpy is not None
+    rows = 0
+
+    with open_csv(path, 'r') as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        missing = [column for column in aggregator.group_by + aggregator.metrics if column not in header]
+        if missing:
+            raise ValueError('Columns not found in {}: {}. Available columns: {}'.format(
+                path, ', '.join(missing), ', '.join(header)))
+
+        group_indexes = [header.index(column) for column in aggregator.group_by]
+        metric_indexes = {metric: header.index(metric) for metric in aggregator.metrics}
+
+        while True:
+            batch = [row for _, row in zip(range(batch_size), reader)]
+            if not batch:
+                break
+
+            keys = [tuple(row[index] if index < len(row) else '' for index in group_indexes) for row in batch]
+            columns = {metric: [row[index] if index < len(row) else '' for row in batch]
+                       for metric, index in metric_indexes.items()}
+
+            if use_numpy:
+                aggregator.add_batch_numpy(keys, columns)
+            else:
+                aggregator.add_batch(keys, columns)
+            rows += len(batch)
+
+    return rows
+
+
+def write_summary(aggregator: ReportAggregator, output_path: str):
+    """Writes one row per group to a CSV file, gzipped if its name ends with .gz."""
+    with open_csv(output_path, 'w') as file:
+        writer = csv.writer(file)
+        writer.writerow(aggregator.summary_header())
+        writer.writerows(aggregator.summary_rows())
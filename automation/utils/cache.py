@@ -0,0 +1,111 @@
+#!/usr/local/bin/python
+"""A small on disk cache where entries are addressed by the hash of their input."""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'apigee-automation')
+
+
+def hash_bytes(data: bytes) -> str:
+    """Returns the sha256 hex digest of the given bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path: str) -> str:
+    """Returns the sha256 hex digest of a file without reading it in memory at once."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentCache:
+    """Cache of byte blobs stored under <cache_dir>/<namespace>/<key>.
+    Writes are atomic so concurrent runs never see half written entries."""
+
+    def __init__(self, namespace: str, cache_dir: str = None):
+        self.folder = os.path.join(cache_dir or DEFAULT_CACHE_DIR, namespace)
+
+    def path_for(self, key: str) -> str:
+        """Location of the entry with the given key, whether it exists or not."""
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key: str) -> bytes:
+        """Returns the cached bytes for the key or None if there is no such entry."""
+        try:
+            with open(self.path_for(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        """Stores the given bytes under the key."""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def put_file(self, key: str, source_path: str) -> str:
+        """Stores a copy of a file under the key without reading it in memory. Returns the entry location."""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as file, open(source_path, 'rb') as source:
+                shutil.copyfileobj(source, file, 1024 * 1024)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        return path
+
+    def touch(self, key: str):
+        """Marks an entry as recently used so that it is evicted last."""
+        try:
+            os.utime(self.path_for(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, max_age: float = None, max_size: int = None) -> int:
+        """Removes the entries not used for more than max_age seconds, then the least recently used
+        ones until the entries take at most max_size bytes. Returns the number of entries removed."""
+        entries = []
+        for folder, _, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        oldest_kept = time.time() - max_age if max_age is not None else None
+        removed = 0
+
+        for modified, size, path in entries:
+            if not (oldest_kept is not None and modified < oldest_kept) \
+                    and not (max_size is not None and total_size > max_size):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed += 1
+
+        return removed
@@ -0,0 +1,261 @@
+#!/usr/local/bin/python
+"""Columnar copy of the gzipped CSV results of analytics reports, so that they can be analysed
+again and again without parsing the CSV. Every column is stored in its own file of fixed size
+values which can be memory mapped; text columns are dictionary encoded. The rows are split in
+blocks whose time range is recorded, so scans over a time range skip the other blocks."""
+import array
+import csv
+import json
+import mmap
+import os
+import sys
+from datetime import datetime, timezone
+
+from utils.aggregator import ReportAggregator, numpy, open_csv
+
+# Bump whenever the layout changes, readers refuse folders written with another version.
+COLUMNAR_VERSION = 1
+
+META_FILE = 'meta.json'
+
+# Columns used as the time index when none is given, compared case insensitively.
+TIME_COLUMNS = ['timeunit', 'timestamp', 'time', 'date']
+
+# Array type codes of the fixed size values of every column type.
+TYPE_CODES = {'int': 'q', 'float': 'd', 'time': 'q', 'text': 'i'}
+
+
+def parse_timestamp(value: str) -> int:
+    """Parses an ISO 8601 date or epoch milliseconds into epoch milliseconds, assuming UTC.
+    Raises a ValueError if the value is neither."""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    parsed = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def infer_types(path: str, time_column: str = None) -> ([], [], str):
+    """Reads the report once to find the type of every column: 'int', 'float' or 'text', and
+    'time' for the time column when all its values are dates. Returns the header, the types
+    and the time column, None if the report has none."""
+    with open_csv(path, 'r') as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        if time_column is None:
+            time_column = next((column for column in header if column.lower() in TIME_COLUMNS), None)
+        elif time_column not in header:
+            raise ValueError('Time column {} not found in {}'.format(time_column, path))
+
+        time_index = header.index(time_column) if time_column is not None else None
+        types = ['int'] * len(header)
+        time_valid = time_index is not None
+
+        for row in reader:
+            for index, value in enumerate(row[:len(header)]):
+                if index == time_index and time_valid:
+                    try:
+                        parse_timestamp(value)
+                    except ValueError:
+                        time_valid = False
+                if types[index] == 'int':
+                    try:
+                        int(value)
+                    except ValueError:
+                        types[index] = 'float'
+                if types[index] == 'float':
+                    try:
+                        float(value or 'nan')
+                    except ValueError:
+                        types[index] = 'text'
+
+    if time_valid:
+        types[time_index] = 'time'
+    elif time_column is not None:
+        print('Column {} does not only hold dates, the result is not indexed on time.'.format(time_column))
+        time_column = None
+
+    return header, types, time_column
+
+
+def convert_csv(path: str, folder: str, time_column: str = None, block_size: int = 65536) -> int:
+    """Converts a report CSV into a columnar folder, reading the CSV twice: once to find the types
+    of the columns, once to write them. Returns the number of rows."""
+    header, types, time_column = infer_types(path, time_column)
+    os.makedirs(folder, exist_ok=True)
+    if is_columnar(folder):
+        os.remove(os.path.join(folder, META_FILE))
+
+    files = [open(os.path.join(folder, '{}.col'.format(index)), 'wb') for index in range(len(header))]
+    buffers = [array.array(TYPE_CODES[column_type]) for column_type in types]
+    dictionaries = [{} if column_type == 'text' else None for column_type in types]
+    time_index = header.index(time_column) if time_column is not None else None
+    zones = []
+    rows = 0
+
+    def flush():
+        if time_index is not None and buffers[time_index]:
+            zones.append([min(buffers[time_index]), max(buffers[time_index])])
+        for file, buffer in zip(files, buffers):
+            buffer.tofile(file)
+            del buffer[:]
+
+    try:
+        with open_csv(path, 'r') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                row = row + [''] * (len(header) - len(row))
+                for index, column_type in enumerate(types):
+                    value = row[index]
+                    if column_type == 'text':
+                        buffers[index].append(dictionaries[index].setdefault(value, len(dictionaries[index])))
+                    elif column_type == 'time':
+                        buffers[index].append(parse_timestamp(value))
+                    elif column_type == 'int':
+                        buffers[index].append(int(value))
+                    else:
+                        buffers[index].append(float(value or 'nan'))
+                rows += 1
+                if rows % block_size == 0:
+                    flush()
+            flush()
+    finally:
+        for file in files:
+            file.close()
+
+    meta = {
+        'version': COLUMNAR_VERSION,
+        'rows': rows,
+        'block_size': block_size,
+        'byteorder': sys.byteorder,
+        'time_column': time_column,
+        'zones': zones,
+        'columns': [{'name': name, 'type': column_type, 'file': '{}.col'.format(index),
+                     'dictionary': list(dictionaries[index]) if dictionaries[index] is not None else None}
+                    for index, (name, column_type) in enumerate(zip(header, types))],
+    }
+    # The metadata is written last so that an interrupted conversion is never mistaken for a complete one.
+    with open(os.path.join(folder, META_FILE), 'w', encoding='utf-8') as file:
+        json.dump(meta, file, ensure_ascii=False)
+
+    return rows
+
+
+def columnar_path(path: str) -> str:
+    """Default folder of the columnar copy of a report: the report path ending with .columnar."""
+    path = path.rstrip('/')
+    return (path[:-len('.csv.gz')] if path.endswith('.csv.gz') else path) + '.columnar'
+
+
+def is_columnar(path: str) -> bool:
+    """Whether the path is a folder written by convert_csv."""
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class ColumnarReport:
+    """Reads a columnar folder. Column files are memory mapped when first used, so only the
+    columns a scan needs are ever read from disk."""
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        with open(os.path.join(folder, META_FILE), 'r', encoding='utf-8') as file:
+            self.meta = json.load(file)
+
+        if self.meta.get('version') != COLUMNAR_VERSION:
+            raise ValueError('{} was written by another version of the columnar format'.format(folder))
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError('{} was written on a machine with another byte order'.format(folder))
+
+        self.rows = self.meta['rows']
+        self.columns = {column['name']: column for column in self.meta['columns']}
+        self._maps = {}
+
+    def values(self, name: str) -> memoryview:
+        """All the raw values of a column: numbers, epoch milliseconds for the time column and
+        dictionary codes for text columns."""
+        if name not in self.columns:
+            raise ValueError('Column {} not found in {}. Available columns: {}'.format(
+                name, self.folder, ', '.join(self.columns)))
+
+        if name not in self._maps:
+            column = self.columns[name]
+            type_code = TYPE_CODES[column['type']]
+            with open(os.path.join(self.folder, column['file']), 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    self._maps[name] = memoryview(array.array(type_code))
+                else:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[name] = memoryview(mapped).cast(type_code)
+        return self._maps[name]
+
+    def blocks(self, start: int = None, end: int = None) -> []:
+        """Row ranges (first, last + 1) of the blocks which may hold rows between the start
+        (inclusive) and end (exclusive) epoch milliseconds. All the rows without a time index."""
+        block_size = self.meta['block_size']
+        if self.meta['time_column'] is None or (start is None and end is None):
+            return [(first, min(first + block_size, self.rows)) for first in range(0, self.rows, block_size)]
+
+        return [(number * block_size, min((number + 1) * block_size, self.rows))
+                for number, (low, high) in enumerate(self.meta['zones'])
+                if (start is None or high >= start) and (end is None or low < end)]
+
+    def read_batches(self, names: [], start: int = None, end: int = None):
+        """Yields the values of the given columns a block at a time, as lists by column name,
+        keeping only the rows between the start (inclusive) and end (exclusive) epoch milliseconds.
+        Text columns are decoded back to strings."""
+        time_column = self.meta['time_column']
+        filtered = time_column is not None and (start is not None or end is not None)
+        if not filtered and (start is not None or end is not None):
+            print('{} is not indexed on time, all the rows are read.'.format(self.folder))
+
+        for first, last in self.blocks(start, end):
+            selected = None
+            if filtered:
+                times = self.values(time_column)[first:last]
+                selected = [index for index, value in enumerate(times)
+                            if (start is None or value >= start) and (end is None or value < end)]
+                if not selected:
+                    continue
+
+            batch = {}
+            for name in names:
+                values = self.values(name)[first:last].tolist()
+                if selected is not None and len(selected) < len(values):
+                    values = [values[index] for index in selected]
+                dictionary = self.columns[name]['dictionary']
+                batch[name] = [dictionary[code] for code in values] if dictionary is not None else values
+            yield batch
+
+    def aggregate(self, aggregator: ReportAggregator, start: int = None, end: int = None,
+                  use_numpy: bool = False) -> int:
+        """Feeds the rows between the start and end epoch milliseconds to the aggregator,
+        reading only the columns it needs. Returns the number of rows."""
+        use_numpy = use_numpy and numpy is not None
+        rows = 0
+
+        for batch in self.read_batches(aggregator.group_by + aggregator.metrics, start, end):
+            count = len(batch[aggregator.metrics[0]]) if aggregator.metrics else \
+                len(next(iter(batch.values()), []))
+            keys = list(zip(*[batch[column] for column in aggregator.group_by])) \
+                if aggregator.group_by else [()] * count
+            if use_numpy:
+                aggregator.add_batch_numpy(keys, batch)
+            else:
+                aggregator.add_batch(keys, batch)
+            rows += count
+
+        return rows
+
+    def close(self):
+        """Releases the memory mapped column files."""
+        for view in self._maps.values():
+            obj = view.obj
+            view.release()
+            if isinstance(obj, mmap.mmap):
+                obj.close()
+        self._maps = {}
@@ -0,0 +1,206 @@
+#!/usr/local/bin/python
+"""Lossless optimizations for the images uploaded to an Apigee portal.
+Only the python standard library is used so no extra dependencies are needed."""
+import os
+import re
+import struct
+import zlib
+
+from utils.cache import ContentCache, hash_bytes
+
+# Bump whenever the optimizations change so that previously cached outputs are not reused.
+OPTIMIZER_VERSION = '2'
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Textual and timestamp chunks which have no effect on how the image is rendered.
+PNG_METADATA_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+# JPEG APPn segments which are kept: JFIF (APP0), ICC profiles (APP2) and Adobe colour
+# transform (APP14) all change how the image is decoded. EXIF (APP1) is handled separately.
+JPEG_KEPT_APP_MARKERS = {0xE0, 0xE2, 0xEE}
+
+
+def optimize_png(data: bytes) -> bytes:
+    """Drops metadata chunks and recompresses the image data with the highest zlib level."""
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    chunks = []
+    image_data = []
+    position = len(PNG_SIGNATURE)
+
+    while position + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        position += length + 12
+
+        if chunk_type == b'IDAT':
+            # All the IDAT chunks are merged in a single one at the position of the first.
+            if not image_data:
+                chunks.append((b'IDAT', None))
+            image_data.append(body)
+        elif chunk_type not in PNG_METADATA_CHUNKS:
+            chunks.append((chunk_type, body))
+
+        if chunk_type == b'IEND':
+            break
+
+    if not image_data:
+        return data
+
+    compressed = zlib.compress(zlib.decompress(b''.join(image_data)), 9)
+
+    output = [PNG_SIGNATURE]
+    for chunk_type, body in chunks:
+        if body is None:
+            body = compressed
+        output.append(struct.pack('>I', len(body)))
+        output.append(chunk_type)
+        output.append(body)
+        output.append(struct.pack('>I', zlib.crc32(chunk_type + body) & 0xffffffff))
+
+    return b''.join(output)
+
+
+def exif_orientation(segment: bytes) -> int:
+    """Returns the orientation stored in an EXIF APP1 segment body, 1 when not present."""
+    if not segment.startswith(b'Exif\x00\x00'):
+        return 1
+
+    tiff = segment[6:]
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+
+    try:
+        ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        entries = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+        for index in range(entries):
+            entry = ifd_offset + 2 + index * 12
+            tag, _, _, value = struct.unpack(endian + 'HHI2s', tiff[entry:entry + 10])
+            if tag == 0x0112:
+                return struct.unpack(endian + 'H', value)[0]
+    except struct.error:
+        return 1
+
+    return 1
+
+
+def optimize_jpeg(data: bytes) -> bytes:
+    """Strips comments and metadata segments (XMP, IPTC, EXIF without a rotation...)
+    without touching the compressed image data."""
+    if not data.startswith(b'\xff\xd8'):
+        return data
+
+    output = [b'\xff\xd8']
+    position = 2
+
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return data
+        marker = data[position + 1]
+
+        # Fill bytes in front of a marker.
+        if marker == 0xFF:
+            position += 1
+            continue
+
+        # Start of scan, everything after this point is image data.
+        if marker == 0xDA:
+            output.append(data[position:])
+            return b''.join(output)
+
+        # Markers without a length.
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            output.append(data[position:position + 2])
+            position += 2
+            continue
+
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        segment = data[position:position + 2 + length]
+        body = segment[4:]
+        position += 2 + length
+
+        if marker == 0xFE:
+            continue
+        if marker == 0xE1:
+            # Keep EXIF only when the image relies on it to be displayed the right way up.
+            if exif_orientation(body) == 1:
+                continue
+        elif 0xE0 <= marker <= 0xEF and marker not in JPEG_KEPT_APP_MARKERS:
+            continue
+
+        output.append(segment)
+
+    return data
+
+
+# Elements in which whitespace between tags is rendered, or is part of a stylesheet or script,
+# followed by the whitespace containing a line break between two tags anywhere else.
+SVG_WHITESPACE = re.compile(
+    r'<(text|foreignObject|style|script)\b.*?</\1\s*>'
+    r'|<([\w:.-]+)\b[^>]*\bxml:space\s*=\s*["\']preserve["\'].*?</\2\s*>'
+    r'|(?<=>)\s*\n\s*(?=<)', flags=re.DOTALL)
+
+
+def minify_svg(data: bytes) -> bytes:
+    """Removes comments, editor metadata and the indentation between tags, except within the
+    elements whose whitespace is rendered."""
+    text = data.decode('utf-8')
+    text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
+    text = re.sub(r'<metadata\b.*?</metadata>', '', text, flags=re.DOTALL)
+    text = SVG_WHITESPACE.sub(lambda match: match.group(0) if match.group(0).startswith('<') else '', text)
+    return text.strip().encode('utf-8')
+
+
+OPTIMIZERS = {
+    '.png': optimize_png,
+    '.jpg': optimize_jpeg,
+    '.jpeg': optimize_jpeg,
+    '.svg': minify_svg,
+}
+
+
+def optimize_image(file_name: str, data: bytes) -> bytes:
+    """Optimizes the image according to its extension. The original bytes are returned for
+    unsupported files, or when the optimization does not make the file smaller."""
+    optimizer = OPTIMIZERS.get(os.path.splitext(file_name)[1].lower())
+    if optimizer is None:
+        return data
+
+    try:
+        optimized = optimizer(data)
+    except (ValueError, struct.error, zlib.error):
+        # A damaged or unusual file is uploaded as is rather than failing the upload.
+        return data
+
+    return optimized if len(optimized) < len(data) else data
+
+
+def optimize_file(path: str, cache: ContentCache = None) -> bytes:
+    """Returns the optimized content of a local file. Outputs are cached by the hash of the
+    input so that repeated runs do not optimize the same file again."""
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in OPTIMIZERS:
+        return data
+
+    key = hash_bytes((OPTIMIZER_VERSION + extension).encode('utf-8') + data)
+
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    optimized = optimize_image(path, data)
+
+    if cache is not None:
+        cache.put(key, optimized)
+
+    return optimized
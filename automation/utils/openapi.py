@@ -0,0 +1,402 @@
+#!/usr/local/bin/python
+"""Helpers to parse and compare OpenAPI specs. YAML specs need PyYAML to be installed,
+without it they are compared as text."""
+import datetime
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.cache import ContentCache, hash_bytes, hash_file
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def parse_spec(data: bytes):
+    """Parses a JSON or YAML spec. Returns None if the spec could not be parsed."""
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    if yaml is None:
+        return None
+
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError:
+        return None
+
+
+def normalized_spec_hash(data: bytes) -> str:
+    """Returns a hash of the spec which does not change with formatting, key ordering or
+    with a JSON spec being converted to YAML and vice versa."""
+    parsed = parse_spec(data)
+
+    if parsed is not None:
+        normalized = json.dumps(parsed, sort_keys=True, separators=(',', ':'), default=str)
+        return hash_bytes(normalized.encode('utf-8'))
+
+    # Fall back on comparing text, ignoring line endings and trailing whitespace.
+    lines = data.replace(b'\r\n', b'\n').split(b'\n')
+    return hash_bytes(b'\n'.join(line.rstrip() for line in lines).strip())
+
+
+# Bump whenever the bundling changes so that previously cached outputs are not reused.
+BUNDLER_VERSION = '2'
+
+# Places holding reusable definitions, for OpenAPI 3 and Swagger 2 specs.
+COMPONENT_SECTIONS = [('components', 'schemas'), ('components', 'responses'),
+                      ('components', 'parameters'), ('components', 'examples'),
+                      ('components', 'requestBodies'), ('components', 'headers'),
+                      ('components', 'links'), ('components', 'callbacks'),
+                      ('definitions',), ('parameters',), ('responses',)]
+
+
+def load_spec_file(path: str):
+    """Parses a JSON or YAML spec file, raising a ValueError if it can't be parsed."""
+    with open(path, 'rb') as file:
+        parsed = parse_spec(file.read())
+
+    if parsed is None:
+        raise ValueError('Could not parse {}{}'.format(
+            path, '' if yaml is not None else ' (YAML specs need PyYAML to be installed)'))
+
+    return parsed
+
+
+def resolve_pointer(document, pointer: str, source: str):
+    """Returns the node referenced by a JSON pointer such as '/components/schemas/Pet'."""
+    node = document
+    for part in pointer.lstrip('/').split('/') if pointer.strip('/') else []:
+        part = part.replace('~1', '/').replace('~0', '~')
+        try:
+            node = node[int(part)] if isinstance(node, list) else node[part]
+        except (KeyError, IndexError, ValueError, TypeError) as error:
+            raise ValueError("Cannot resolve '#{}' in {}".format(pointer, source)) from error
+    return node
+
+
+# Kind of object expected under a key, used to decide where an external reference is moved to.
+# 'map:' and 'list:' kinds hold objects of the given kind by name or by position.
+KEY_KINDS = {
+    'schema': 'schemas', 'items': 'schemas', 'additionalProperties': 'schemas', 'not': 'schemas',
+    'properties': 'map:schemas', 'patternProperties': 'map:schemas', 'definitions': 'map:schemas',
+    'schemas': 'map:schemas', 'allOf': 'list:schemas', 'anyOf': 'list:schemas', 'oneOf': 'list:schemas',
+    'parameters': 'list:parameters', 'responses': 'map:responses', 'requestBody': 'requestBodies',
+    'requestBodies': 'map:requestBodies', 'headers': 'map:headers', 'examples': 'map:examples',
+    'links': 'map:links', 'callbacks': 'map:callbacks',
+}
+
+# Sections holding the reusable objects of every kind, for OpenAPI 3 and Swagger 2 specs.
+OPENAPI_SECTIONS = {kind: ('components', kind) for kind in
+                    ['schemas', 'parameters', 'responses', 'requestBodies', 'headers', 'examples',
+                     'links', 'callbacks']}
+SWAGGER_SECTIONS = {'schemas': ('definitions',), 'parameters': ('parameters',), 'responses': ('responses',)}
+
+
+def escape_pointer(part: str) -> str:
+    """Escapes a key to be used in a JSON pointer."""
+    return str(part).replace('~', '~0').replace('/', '~1')
+
+
+class SpecBundler:
+    """Bundles a spec split across many files into a single document. The objects referenced in
+    other local files are moved once into the components (definitions for Swagger 2) of the spec
+    and referenced from there, so shared and recursive schemas are neither copied nor expanded.
+    References within the root document are kept as they are."""
+
+    def __init__(self, root_path: str):
+        self.root_path = os.path.abspath(root_path)
+        self.documents = {}
+        self.sections = {}
+        # Internal reference of every external object already moved, by (file, pointer).
+        self.moved = {}
+
+    def load(self, path: str):
+        """Loads a document once, however many times it is referenced."""
+        if path not in self.documents:
+            self.documents[path] = load_spec_file(path)
+        return self.documents[path]
+
+    def bundle(self):
+        """Returns the bundled root document."""
+        root = self.load(self.root_path)
+        self.sections = SWAGGER_SECTIONS if isinstance(root, dict) and 'swagger' in root else OPENAPI_SECTIONS
+        bundled = self.resolve(root, self.root_path, 'document', [])
+
+        for section, name, value in self.moved.values():
+            container = bundled
+            for part in section:
+                container = container.setdefault(part, {})
+            container[name] = value
+
+        return bundled
+
+    def move(self, target: str, pointer: str, kind: str) -> dict:
+        """Moves an external object into its section, once, and returns a reference to it."""
+        location = (target, pointer)
+        if location not in self.moved:
+            section = self.sections[kind]
+            name = pointer.rstrip('/').rsplit('/', 1)[-1].replace('~1', '/').replace('~0', '~') \
+                if pointer.strip('/') else os.path.splitext(os.path.basename(target))[0]
+
+            root = self.documents[self.root_path]
+            taken = {(moved_section, moved_name) for moved_section, moved_name, _ in self.moved.values()}
+            existing = root
+            for part in section:
+                existing = existing.get(part, {}) if isinstance(existing, dict) else {}
+            unique_name = name
+            suffix = 2
+            while (section, unique_name) in taken or unique_name in existing:
+                unique_name = '{}_{}'.format(name, suffix)
+                suffix += 1
+
+            # Registered before resolving the object so that recursive references point to it.
+            self.moved[location] = (section, unique_name, None)
+            value = self.resolve(resolve_pointer(self.load(target), pointer, target), target, kind, [])
+            self.moved[location] = (section, unique_name, value)
+
+        section, name, _ = self.moved[location]
+        return {'$ref': '#/' + '/'.join(escape_pointer(part) for part in section + (name,))}
+
+    def resolve(self, node, path: str, kind: str, stack: []):
+        """Returns a copy of the node with its external references moved or inlined."""
+        if isinstance(node, list):
+            item_kind = kind[5:] if kind and kind.startswith('list:') else None
+            return [self.resolve(item, path, item_kind, stack) for item in node]
+
+        if not isinstance(node, dict):
+            return node
+
+        ref = node.get('$ref')
+        if isinstance(ref, str) and not ref.startswith(('http://', 'https://')):
+            file_part, _, pointer = ref.partition('#')
+
+            # Keep references within the root document, they are still valid once bundled.
+            if file_part or path != self.root_path:
+                target = os.path.normpath(os.path.join(os.path.dirname(path), file_part)) \
+                    if file_part else path
+                if target == self.root_path:
+                    return {'$ref': '#' + pointer}
+
+                if kind in self.sections:
+                    return self.move(target, pointer, kind)
+
+                # Objects which have no section of their own are copied where they are used.
+                location = (target, pointer)
+                if location in stack:
+                    raise ValueError('Circular reference to {}#{} cannot be bundled'.format(*location))
+
+                resolved = resolve_pointer(self.load(target), pointer, target)
+                return self.resolve(resolved, target, kind, stack + [location])
+
+        # Parameters are listed in operations but kept by name in the Swagger 2 parameters section.
+        if kind and kind.startswith(('map:', 'list:')):
+            item_kind = kind.split(':', 1)[1]
+            return {key: self.resolve(value, path, item_kind, stack) for key, value in node.items()}
+
+        return {key: self.resolve(value, path, KEY_KINDS.get(key), stack) for key, value in node.items()}
+
+
+def collect_refs(node, refs: set):
+    """Adds all the internal references ('#/...') found in the node to refs."""
+    if isinstance(node, list):
+        for item in node:
+            collect_refs(item, refs)
+    elif isinstance(node, dict):
+        ref = node.get('$ref')
+        if isinstance(ref, str) and ref.startswith('#/'):
+            refs.add(tuple(part.replace('~1', '/').replace('~0', '~') for part in ref[2:].split('/')))
+        for value in node.values():
+            collect_refs(value, refs)
+
+
+def strip_unused_components(spec: dict) -> dict:
+    """Removes the reusable definitions which are not referenced, directly or indirectly,
+    from outside of the definitions. Security schemes are always kept."""
+    definitions = {}
+    for section in COMPONENT_SECTIONS:
+        container = spec
+        for part in section:
+            container = container.get(part) if isinstance(container, dict) else None
+        if isinstance(container, dict):
+            for name, value in container.items():
+                definitions[section + (name,)] = value
+
+    used = set()
+    outside = {key: value for key, value in spec.items() if key not in ('components', 'definitions')}
+    # Swagger 2 parameters and responses sections only hold definitions.
+    if 'swagger' in spec:
+        outside.pop('parameters', None)
+        outside.pop('responses', None)
+    collect_refs(outside, used)
+
+    pending = list(used)
+    while pending:
+        ref = pending.pop()
+        found = set()
+        for length in range(len(ref), 0, -1):
+            if ref[:length] in definitions:
+                collect_refs(definitions[ref[:length]], found)
+                used.add(ref[:length])
+                break
+        pending.extend(found - used)
+        used |= found
+
+    for key in definitions:
+        if key not in used:
+            container = spec
+            for part in key[:-1]:
+                container = container[part]
+            del container[key[-1]]
+
+    return spec
+
+
+def json_default(value):
+    """Converts the values YAML parses which JSON has no type for, dates and timestamps."""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def serialize_spec(spec, output_format: str) -> bytes:
+    """Serializes a spec compactly, either as minified JSON or as YAML."""
+    if output_format == 'yaml':
+        if yaml is None:
+            raise ValueError('PyYAML needs to be installed to write YAML specs')
+        return yaml.safe_dump(spec, sort_keys=False, allow_unicode=True, width=2 ** 16).encode('utf-8')
+
+    # YAML dates and timestamps are written back as the ISO strings they were in the spec.
+    return json.dumps(spec, separators=(',', ':'), ensure_ascii=False, default=json_default).encode('utf-8')
+
+
+def bundle_spec_file(path: str, output_format: str = 'json', cache: ContentCache = None) -> str:
+    """Bundles a spec split across many files into a single compact document, with the unused
+    definitions removed. Returns the path of the bundled spec, which is kept in the cache.
+    A cached bundle is reused as long as none of the files it was built from changed."""
+    path = os.path.abspath(path)
+    cache = cache or ContentCache('specs')
+    key = hash_bytes('\0'.join([BUNDLER_VERSION, output_format, path, hash_file(path)]).encode('utf-8'))
+
+    cached = cache.get(key)
+    if cached is not None:
+        entry = json.loads(cached.decode('utf-8'))
+        if all(os.path.exists(dependency) and hash_file(dependency) == digest
+               for dependency, digest in entry['dependencies'].items()) \
+                and os.path.exists(cache.path_for(entry['output'])):
+            return cache.path_for(entry['output'])
+
+    bundler = SpecBundler(path)
+    output = serialize_spec(strip_unused_components(bundler.bundle()), output_format)
+
+    output_key = hash_bytes(output)
+    cache.put(output_key, output)
+    cache.put(key, json.dumps({
+        'dependencies': {dependency: hash_file(dependency) for dependency in bundler.documents},
+        'output': output_key}).encode('utf-8'))
+
+    return cache.path_for(output_key)
+
+
+# Bump whenever the validation changes so that previously cached results are not reused.
+VALIDATOR_VERSION = '1'
+
+HTTP_METHODS = ['get', 'put', 'post', 'delete', 'options', 'head', 'patch', 'trace']
+
+
+def validate_spec(spec) -> []:
+    """Checks the overall structure of an OpenAPI 3 or Swagger 2 spec and that its internal
+    references can be resolved. Returns the list of problems found."""
+    if not isinstance(spec, dict):
+        return ['the spec is not an object']
+
+    errors = []
+
+    if not str(spec.get('openapi', '')).startswith('3.') and str(spec.get('swagger', '')) != '2.0':
+        errors.append("missing or unsupported 'openapi'/'swagger' version")
+
+    info = spec.get('info')
+    if not isinstance(info, dict):
+        errors.append("missing 'info' object")
+    else:
+        for field in ('title', 'version'):
+            if not info.get(field):
+                errors.append("missing 'info.{}'".format(field))
+
+    paths = spec.get('paths')
+    if not isinstance(paths, dict):
+        errors.append("missing 'paths' object")
+        paths = {}
+
+    for path, operations in paths.items():
+        if not str(path).startswith('/'):
+            errors.append("path '{}' does not start with '/'".format(path))
+        if not isinstance(operations, dict):
+            errors.append("path '{}' is not an object".format(path))
+            continue
+        for method in HTTP_METHODS:
+            operation = operations.get(method)
+            if operation is not None and not (isinstance(operation, dict)
+                                              and isinstance(operation.get('responses'), dict)
+                                              and operation['responses']):
+                errors.append("operation '{} {}' has no responses".format(method.upper(), path))
+
+    refs = set()
+    collect_refs(spec, refs)
+    for ref in sorted(refs):
+        try:
+            resolve_pointer(spec, '/'.join(part.replace('~', '~0').replace('/', '~1') for part in ref),
+                            'the spec')
+        except ValueError:
+            errors.append("unresolved reference '#/{}'".format('/'.join(ref)))
+
+    return errors
+
+
+def validate_spec_file(path: str, cache_dir: str = None) -> []:
+    """Parses and validates a spec file. Results are cached by the hash of the file, so
+    unchanged specs are not parsed again."""
+    cache = ContentCache('spec-validation', cache_dir)
+    key = hash_bytes((VALIDATOR_VERSION + hash_file(path)).encode('utf-8'))
+
+    cached = cache.get(key)
+    if cached is not None:
+        return json.loads(cached.decode('utf-8'))
+
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    spec = parse_spec(data)
+    if spec is None:
+        if yaml is None and not data.lstrip().startswith((b'{', b'[')):
+            # Can't tell whether the YAML is valid, and not worth caching either.
+            print('PyYAML is not installed, skipping validation of {}'.format(path))
+            return []
+        errors = ['the spec could not be parsed as JSON or YAML']
+    else:
+        errors = validate_spec(spec)
+
+    cache.put(key, json.dumps(errors).encode('utf-8'))
+    return errors
+
+
+def preflight_specs(paths: [], cache_dir: str = None, workers: int = None) -> {}:
+    """Validates many spec files in parallel, across processes since parsing is CPU bound.
+    Returns the problems found for each spec which is not valid."""
+    paths = list(paths)
+    if len(paths) <= 1:
+        results = [validate_spec_file(path, cache_dir) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(validate_spec_file, paths, [cache_dir] * len(paths)))
+
+    return {path: errors for path, errors in zip(paths, results) if errors}
@@ -0,0 +1,104 @@
+#!/usr/local/bin/python
+"""Helpers to split an analytics report into time windows and to merge the results back."""
+import gzip
+import json
+import shutil
+from datetime import datetime, timedelta
+
+from utils.cache import hash_bytes
+
+# Formats accepted for the start and end dates, with or without a trailing 'Z'.
+TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d']
+
+SHARD_UNITS = ['day', 'week']
+
+# Time units a report can be grouped by, from the shortest.
+TIME_UNITS = ['second', 'minute', 'hour', 'day', 'week', 'month']
+
+# Bump whenever the way results are produced changes so that previously cached windows are not reused.
+RESULT_CACHE_VERSION = '1'
+
+# Analytics data keeps arriving for a while after the events, so recent windows are not cached.
+SETTLING_TIME = timedelta(hours=1)
+
+
+def parse_time(value: str) -> datetime:
+    """Parses an ISO 8601 UTC date such as 2020-01-31T00:00:00, raising a ValueError if it isn't one."""
+    text = value[:-1] if value.endswith('Z') else value
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, time_format)
+        except ValueError:
+            pass
+    raise ValueError("'{}' is not an ISO 8601 date (yyyy-MM-ddTHH:mm:ss)".format(value))
+
+
+def format_time(value: datetime, template: str) -> str:
+    """Formats a date the same way as the template date it was derived from."""
+    return value.strftime('%Y-%m-%dT%H:%M:%S') + ('Z' if template.endswith('Z') else '')
+
+
+def check_shard_unit(group_by_time_unit: str, unit: str):
+    """Raises a ValueError unless the rows of a report grouped by this time unit can be split into
+    windows of the shard unit. Otherwise every window would hold its own totals, which can't be
+    merged back into those of the whole range."""
+    if not group_by_time_unit:
+        raise ValueError('Sharding needs the report to be grouped by time, set a groupByTimeUnit '
+                         'of at most a {}'.format(unit))
+
+    if group_by_time_unit not in TIME_UNITS or TIME_UNITS.index(group_by_time_unit) > TIME_UNITS.index(unit):
+        raise ValueError("A report grouped by '{}' can't be sharded by {}, the groupByTimeUnit must be "
+                         "one of: {}".format(group_by_time_unit, unit,
+                                             ', '.join(TIME_UNITS[:TIME_UNITS.index(unit) + 1])))
+
+
+def split_time_range(start: str, end: str, unit: str) -> []:
+    """Splits a time range into consecutive windows aligned on days, or on weeks starting on Monday.
+    The first and last windows are shorter when the range does not start or end on a boundary.
+    Returns (start, end) pairs formatted like the start date, in chronological order."""
+    if unit not in SHARD_UNITS:
+        raise ValueError('Unsupported shard unit: {}'.format(unit))
+
+    start_time = parse_time(start)
+    end_time = parse_time(end)
+    if end_time <= start_time:
+        raise ValueError('The end date {} is not after the start date {}'.format(end, start))
+
+    windows = []
+    window_start = start_time
+    while window_start < end_time:
+        boundary = datetime(window_start.year, window_start.month, window_start.day) + timedelta(days=1)
+        if unit == 'week':
+            boundary += timedelta(days=(7 - boundary.weekday()) % 7)
+        window_end = min(boundary, end_time)
+        windows.append((format_time(window_start, start), format_time(window_end, start)))
+        window_start = window_end
+
+    return windows
+
+
+def window_cache_key(org_name: str, env: str, query: dict, window: tuple) -> str:
+    """Key of the cached result of a query over a time window. The query is normalized so that key
+    ordering and formatting, as well as the time range it was submitted with, do not matter."""
+    normalized = {key: value for key, value in query.items() if key != 'timeRange'}
+    data = json.dumps([RESULT_CACHE_VERSION, org_name, env, normalized,
+                       [parse_time(window[0]).isoformat(), parse_time(window[1]).isoformat()]],
+                      sort_keys=True, separators=(',', ':'))
+    return hash_bytes(data.encode('utf-8'))
+
+
+def window_elapsed(window: tuple, now: datetime = None) -> bool:
+    """Whether the window ended long enough ago for its result not to change any more."""
+    return parse_time(window[1]) + SETTLING_TIME <= (now or datetime.utcnow())
+
+
+def merge_csv_gz(paths: [], output_path: str):
+    """Concatenates gzipped CSV files in the given order into a single gzipped CSV, keeping the header
+    of the first file only. Files are streamed in chunks so they are never loaded in memory."""
+    with gzip.open(output_path, 'wb') as output:
+        for index, path in enumerate(paths):
+            with gzip.open(path, 'rb') as part:
+                header = part.readline()
+                if index == 0:
+                    output.write(header)
+                shutil.copyfileobj(part, output, 1024 * 1024)
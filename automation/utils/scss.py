@@ -0,0 +1,119 @@
+#!/usr/local/bin/python
+"""Local checks and minification of the SCSS sent as part of an Apigee portal theme.
+The portal compiles the SCSS itself, against its own variables and mixins, so the
+SCSS is validated and minified here at the source level rather than compiled to CSS."""
+import json
+
+from utils.cache import ContentCache, hash_bytes
+
+# Bump whenever the validation or the minification changes so that cached results are not reused.
+SCSS_VERSION = '2'
+
+BRACKETS = {'(': ')', '[': ']', '{': '}'}
+
+
+def scan_scss(scss: str, source: str = 'scss') -> ([], str):
+    """Walks through the SCSS once, returning the structural errors found (unbalanced
+    brackets, unterminated strings or comments) and a minified copy of the SCSS.
+    Strings, url() arguments and /*! comments are copied as they are."""
+    errors = []
+    output = []
+    stack = []
+    line = 1
+    pending_space = False
+    # Whether the last character emitted closes a #{...} interpolation, which is part of a selector
+    # or value, so the whitespace after it is significant unlike after a block.
+    after_interpolation = False
+    position = 0
+    length = len(scss)
+
+    def emit(text: str, closes_interpolation: bool = False):
+        nonlocal pending_space, after_interpolation
+        if pending_space and output and (after_interpolation or output[-1][-1] not in '{};,') \
+                and text[0] not in '{};,':
+            output.append(' ')
+        pending_space = False
+        after_interpolation = closes_interpolation
+        output.append(text)
+
+    while position < length:
+        char = scss[position]
+
+        if char in ' \t\r\n\f':
+            line += char == '\n'
+            pending_space = True
+            position += 1
+        elif scss.startswith('/*', position):
+            end = scss.find('*/', position + 2)
+            if end == -1:
+                errors.append('{}:{}: unterminated comment'.format(source, line))
+                end = length
+            comment = scss[position:end + 2]
+            if comment.startswith('/*!'):
+                emit(comment)
+            line += comment.count('\n')
+            pending_space = True
+            position = end + 2
+        elif scss.startswith('//', position):
+            end = scss.find('\n', position)
+            position = length if end == -1 else end
+            pending_space = True
+        elif char in '"\'':
+            end = position + 1
+            while end < length and scss[end] != char and scss[end] != '\n':
+                end += 2 if scss[end] == '\\' else 1
+            if end >= length or scss[end] != char:
+                errors.append('{}:{}: unterminated string'.format(source, line))
+            emit(scss[position:end + 1])
+            position = end + 1
+        elif scss.startswith('url(', position) and scss[position + 4:position + 5] not in ('"', "'"):
+            end = scss.find(')', position)
+            if end == -1:
+                errors.append('{}:{}: unterminated url('.format(source, line))
+                end = length
+            emit(scss[position:end + 1])
+            line += scss[position:end + 1].count('\n')
+            position = end + 1
+        else:
+            closes_interpolation = False
+            if char in BRACKETS:
+                stack.append((BRACKETS[char], line, char == '{' and scss[position - 1:position] == '#'))
+            elif char in BRACKETS.values():
+                if not stack:
+                    errors.append("{}:{}: unexpected '{}'".format(source, line, char))
+                elif stack[-1][0] != char:
+                    errors.append("{}:{}: expected '{}' but found '{}'".format(
+                        source, line, stack[-1][0], char))
+                    stack.pop()
+                else:
+                    closes_interpolation = stack.pop()[2]
+            emit(char, closes_interpolation)
+            position += 1
+
+    for closing, opened_at, _ in reversed(stack):
+        errors.append("{}:{}: '{}' is never closed".format(source, opened_at, closing))
+
+    return errors, ''.join(output)
+
+
+def prepare_scss(scss: str, source: str, minify: bool = False, cache: ContentCache = None) -> str:
+    """Validates the SCSS and returns what should be sent to the portal, the minified SCSS if
+    minify is set. Raises a ValueError listing the problems if the SCSS is not valid.
+    Results are cached by the hash of the input so unchanged files are not scanned again."""
+    if not scss:
+        return scss
+
+    key = hash_bytes('\0'.join([SCSS_VERSION, source, scss]).encode('utf-8'))
+    cached = cache.get(key) if cache is not None else None
+
+    if cached is not None:
+        errors, minified = json.loads(cached.decode('utf-8'))
+    else:
+        errors, minified = scan_scss(scss, source)
+        if cache is not None:
+            cache.put(key, json.dumps([errors, minified]).encode('utf-8'))
+
+    if errors:
+        raise ValueError('Invalid SCSS in {}:\n{}'.format(source, '\n'.join(errors)))
+
+    return minified if minify else scss
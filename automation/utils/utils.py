@@ -1,6 +1,10 @@
 #!/usr/local/bin/python
 """Some common utilities used by these script"""
+import codecs
 import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def print_error(response) -> str:
     """Prints the error returned from an API call"""
@@ -22,4 +26,84 @@ def print_error(response) -> str:
         f'Content-Type: {ct}\n'
         f'URL: {req_method} {req_url}\n'
         f'Response body:\n{body_str}'
-    )
\ No newline at end of file
+    )
+
+
+def load_state(state_path: str) -> {}:
+    """Loads the JSON state file kept between runs, empty if there is no such file."""
+    if not state_path or not os.path.exists(state_path):
+        return {}
+
+    with open(state_path, 'r', encoding='utf8') as file:
+        return json.load(file)
+
+
+def save_state(state_path: str, state: {}):
+    """Saves the JSON state file for the next runs. The file is replaced atomically so that it is
+    never left half written if the run is interrupted."""
+    if not state_path:
+        return
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state_path)))
+    try:
+        with os.fdopen(handle, 'w', encoding='utf8') as file:
+            json.dump(state, file, indent=2, sort_keys=True)
+        os.replace(temp_path, state_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class BatchResult:
+    """Aggregated outcome of running the same operation on many items."""
+    def __init__(self):
+        self.succeeded = {}
+        self.failed = {}
+
+    def print_summary(self, action: str):
+        """Prints how many items succeeded and why the others failed."""
+        print('{} {} item(s), {} failed.'.format(action, len(self.succeeded), len(self.failed)))
+        for name in sorted(self.failed):
+            print(' - {}: {}'.format(name, self.failed[name]))
+
+
+def run_concurrently(func, names: [], max_workers: int) -> BatchResult:
+    """Calls func(name) for every name using at most max_workers threads. The returned
+    values and the errors raised are collected per name instead of stopping at the first failure."""
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return collect_results({executor.submit(func, name): name for name in names})
+
+
+def collect_results(futures: {}) -> BatchResult:
+    """Waits for futures, given with the name of the item each of them is for, and collects
+    their returned values and the errors they raised per name."""
+    result = BatchResult()
+
+    for future in as_completed(futures):
+        name = futures[future]
+        try:
+            result.succeeded[name] = future.result()
+        except Exception as error:
+            result.failed[name] = str(error)
+
+    return result
+
+
+class Utf8FileStream:
+    """Streams a file in chunks as a request body, with a known length so that requests sends a
+    Content-Length header rather than a chunked body. The content is checked to be valid UTF-8 as
+    it is being read, so the file never needs to be fully loaded or copied in memory."""
+    def __init__(self, path: str, chunk_size: int = 1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return os.path.getsize(self.path)
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with open(self.path, 'rb') as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), b''):
+                decoder.decode(chunk)
+                yield chunk
+        decoder.decode(b'', final=True)